@@ -0,0 +1,401 @@
+#!/usr/bin/env python3
+# Copyright (C) 2022 Ben Pepe
+import os
+import sys
+import argparse
+import importlib.util
+import json
+import random
+import shutil
+import subprocess
+import tempfile
+import time
+import types
+from contextlib import redirect_stdout
+
+# This script generates a reproducible synthetic OpenWrt tree and times the
+# stages of pepe_xxx_chk-license-info.py and pepe_xxx-prepare-gpl-release.py
+# on it. Results are written as JSON so runs can be compared across commits.
+#
+# Generated layout:
+#    <work>/tree/package/<category>/<package>/Makefile      packages, some with
+#                                                           nested Makefiles, src/
+#                                                           vendored sources and .git
+#    <work>/tree/feeds/packages/<category>/<package>        feed packages
+#    <work>/tree/package/feeds/packages -> feeds/packages   feed links
+#    <work>/tree/xxx/feeds/<package>                        xxx packages
+#    <work>/tree/xxx/chipcode/<version>/codexxxxx           chipcode, used and unused
+#    <work>/tree/buildap/target/<target>/xxx_config.py      target configs
+#    <work>/mirror/                                         tarball mirror with decoys
+#    <work>/package-full-list                               list used to filter tarballs
+#    <work>/scripts.git                                     xxx_scripts repository
+
+###### Variables ######
+script_dir = os.path.dirname(os.path.abspath(__file__))
+chk_license_path = os.path.join(script_dir, 'pepe_xxx_chk-license-info.py')
+prepare_release_path = os.path.join(script_dir, 'pepe_xxx-prepare-gpl-release.py')
+license_list = ['GPL-2.0', 'GPL-2.0+', 'LGPL-2.1+', 'GPL-3.0', 'MIT', 'BSD-3-Clause', 'ISC', 'Apache-2.0']
+category_list = ['utils', 'network', 'libs', 'kernel', 'system', 'lang']
+###### Functions ######
+
+
+def load_script(path, name):
+    # The scripts have dashes in their names so they are loaded by path
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def write_file(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as write_file:
+        write_file.write(data)
+
+
+def package_makefile(rand, package_name, version):
+    lines = ['include $(TOPDIR)/rules.mk', '',
+             'PKG_NAME:=%s' % package_name,
+             'PKG_VERSION:=%s' % version,
+             'PKG_RELEASE:=1', '',
+             'PKG_SOURCE:=$(PKG_NAME)-$(PKG_VERSION).tar.xz']
+    roll = rand.random()
+    if roll < 0.05:
+        lines.append('PKG_PROPRIETARY:=1')
+    elif roll < 0.10:
+        # Malformed gpl license
+        lines.append('PKG_LICENSE:=GPLv2')
+        lines.append('PKG_LICENSE_FILES:=COPYING')
+    elif roll < 0.15:
+        lines.append('PKG_LICENSE:=%s' % rand.choice(license_list))
+    else:
+        licenses = rand.sample(license_list, rand.randint(1, 3))
+        files = ['COPYING'] + ['LICENSE.%d' % i for i in range(1, len(licenses))]
+        lines.append('PKG_LICENSE:=%s' % ' '.join(licenses))
+        lines.append('PKG_LICENSE_FILES:=%s' % ' \\\n                  '.join(files))
+    lines += ['', 'include $(INCLUDE_DIR)/package.mk', '',
+              'define Package/%s' % package_name,
+              '  SECTION:=utils',
+              '  TITLE:=%s synthetic package' % package_name,
+              'endef', '',
+              '$(eval $(call BuildPackage,%s))' % package_name, '']
+    return '\n'.join(lines)
+
+
+def make_package(rand, package_dir, package_name, version, opts):
+    write_file(os.path.join(package_dir, 'Makefile'), package_makefile(rand, package_name, version))
+    if rand.random() < opts.nested_ratio:
+        write_file(os.path.join(package_dir, 'kmod', 'Makefile'), 'KMOD_NAME:=%s\n' % package_name)
+    if rand.random() < opts.vendored_ratio:
+        for i in range(opts.vendored_files):
+            sub_dir = os.path.join(package_dir, 'src', 'dir%d' % (i % 5))
+            write_file(os.path.join(sub_dir, 'file%d.c' % i), 'int f%d(void) { return %d; }\n' % (i, i))
+        write_file(os.path.join(package_dir, 'src', 'Makefile'), 'all:\n\t$(CC) -o x *.c\n')
+    if rand.random() < opts.git_ratio:
+        write_file(os.path.join(package_dir, '.git', 'HEAD'), 'ref: refs/heads/master\n')
+        write_file(os.path.join(package_dir, '.gitignore'), '*.o\n')
+    write_file(os.path.join(package_dir, 'patches', '001-fix.patch'), '--- a\n+++ b\n')
+
+
+def make_tree(work_dir, opts):
+    """
+    Generates the synthetic tree, mirror and package list under work_dir
+    and returns the list of (package_name, version)
+    """
+    rand = random.Random(opts.seed)
+    tree_dir = os.path.join(work_dir, 'tree')
+    mirror_dir = os.path.join(work_dir, 'mirror')
+    os.makedirs(mirror_dir)
+    packages = []
+    for i in range(opts.packages):
+        package_name = 'pkg%05d' % i
+        version = '%d.%d.%d' % (rand.randint(0, 9), rand.randint(0, 20), rand.randint(0, 50))
+        roll = rand.random()
+        if roll < opts.feeds_ratio:
+            package_dir = os.path.join(tree_dir, 'feeds', 'packages', rand.choice(category_list), package_name)
+        elif roll < opts.feeds_ratio + opts.xxx_ratio:
+            package_dir = os.path.join(tree_dir, 'xxx', 'feeds', package_name)
+        else:
+            package_dir = os.path.join(tree_dir, 'package', rand.choice(category_list), package_name)
+        make_package(rand, package_dir, package_name, version, opts)
+        packages.append((package_name, version))
+        write_file(os.path.join(mirror_dir, '%s-%s.tar.xz' % (package_name, version)), package_name)
+        # Other versions of the same package in the mirror
+        for j in range(opts.mirror_decoys):
+            write_file(os.path.join(mirror_dir, '%s-%s.%d.tar.xz' % (package_name, version, j)), package_name)
+
+    os.makedirs(os.path.join(tree_dir, 'package', 'feeds'), exist_ok=True)
+    os.makedirs(os.path.join(tree_dir, 'feeds', 'packages'), exist_ok=True)
+    os.symlink(os.path.join('..', '..', 'feeds', 'packages'), os.path.join(tree_dir, 'package', 'feeds', 'packages'))
+    write_file(os.path.join(tree_dir, 'Makefile'), 'world:\n')
+    write_file(os.path.join(tree_dir, 'package', 'Makefile'), 'prereq:\n')
+    for excluded in ['build_dir', 'staging_dir', 'tmp']:
+        for i in range(opts.vendored_files):
+            write_file(os.path.join(tree_dir, excluded, 'noise%d' % (i % 3), 'file%d' % i), 'x\n')
+
+    chipcode_dir = os.path.join(tree_dir, 'xxx', 'chipcode')
+    for i in range(opts.chipcode_versions):
+        version_dir = os.path.join(chipcode_dir, 'v%d' % i)
+        write_file(os.path.join(version_dir, 'codexxxxx', 'firmware.bin'), 'fw%d\n' % i)
+        write_file(os.path.join(version_dir, 'internal', 'notes.txt'), 'internal\n')
+    for i in range(opts.targets):
+        config = ["model='target%d'" % i,
+                  "xxx_chipcode_ver='v%d'" % (i % max(1, opts.chipcode_versions // 2)),
+                  "toolchain_pack='toolchain-gcc%d'" % (i % 2),
+                  "dns=['10.0.0.1']", '']
+        write_file(os.path.join(tree_dir, 'buildap', 'target', 'target%d' % i, 'xxx_config.py'), '\n'.join(config))
+    for i in range(2):
+        write_file(os.path.join(mirror_dir, 'toolchain-gcc%d-12.3.tar.xz' % i), 'toolchain')
+    for dir_name in ['xxx-tools', 'buildap', 'docker']:
+        write_file(os.path.join(tree_dir, dir_name, 'README.md'), 'internal\n')
+    write_file(os.path.join(tree_dir, '.gitmodules'), '')
+    write_file(os.path.join(tree_dir, 'xxxprop', 'secret.c'), 'secret\n')
+
+    with open(os.path.join(work_dir, 'package-full-list'), 'w') as write_list:
+        for package_name, version in packages:
+            # Every fourth package names its source, the rest are resolved by name and version
+            source_name = '%s-%s.tar.xz' % (package_name, version) if rand.random() < 0.25 else ''
+            proprietary = '1' if rand.random() < 0.05 else '0'
+            write_list.write('%s\n%s\n%s\n%s\n' % (source_name, package_name, version, proprietary))
+
+    make_scripts_repo(work_dir)
+
+    return packages
+
+
+def make_scripts_repo(work_dir):
+    # xxx_scripts files and the bare repository the release script clones them from
+    scripts_dir = os.path.join(work_dir, 'scripts')
+    for file_name in ['buildap.py', 'buildap_docker.py', 'helpers.py', 'internal_tool.py']:
+        write_file(os.path.join(scripts_dir, file_name), '# %s\n' % file_name)
+    write_file(os.path.join(scripts_dir, 'docker_config.py'), "image='xxx'\ndns=['10.0.0.1']\n")
+    if not shutil.which('git'):
+        return
+    env = dict(os.environ, GIT_AUTHOR_NAME='bench', GIT_AUTHOR_EMAIL='bench@localhost',
+               GIT_COMMITTER_NAME='bench', GIT_COMMITTER_EMAIL='bench@localhost')
+    for args in [['git', 'init', '-q'], ['git', 'add', '.'], ['git', 'commit', '-qm', 'scripts']]:
+        subprocess.run(args, cwd=scripts_dir, env=env, check=True)
+    subprocess.run(['git', 'clone', '-q', '--bare', scripts_dir, os.path.join(work_dir, 'scripts.git')], check=True)
+
+
+def copy_release_tree(work_dir, name):
+    # remove_files and local mode change the tree, they run on a copy
+    copy_dir = os.path.join(work_dir, name)
+    if os.path.exists(copy_dir):
+        shutil.rmtree(copy_dir)
+    shutil.copytree(os.path.join(work_dir, 'tree'), copy_dir, symlinks=True)
+    return copy_dir
+
+
+def release_opts(work_dir, **kwargs):
+    opts = types.SimpleNamespace(verbose_bol=False, package_list_dir=os.path.join(work_dir, 'package-full-list'),
+                                 jobs=4, dry_run_bol=False, mirror=os.path.join(work_dir, 'mirror'),
+                                 compress_format='xz', compress_level=1, compress_threads=0, compress_memory=2048)
+    opts.__dict__.update(kwargs)
+    return opts
+
+
+def run_benchmark(name, function, repeat, setup=None):
+    """
+    Runs setup (untimed) and function repeat times and returns a result record
+    """
+    seconds = []
+    for i in range(repeat):
+        state = setup() if setup else None
+        start = time.perf_counter()
+        with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+            function(state)
+        seconds.append(time.perf_counter() - start)
+    seconds.sort()
+    result = {'name': name, 'seconds': seconds, 'min': seconds[0], 'median': seconds[len(seconds) // 2]}
+    print('%-40s min %8.4fs  median %8.4fs' % (name, result['min'], result['median']), file=sys.stderr)
+    return result
+
+
+def benchmark_chk_license(work_dir, packages, repeat, cache_dir):
+    chk = load_script(chk_license_path, 'chk_license_info')
+    tree_dir = os.path.join(work_dir, 'tree')
+    os.chdir(tree_dir)
+    # Feeds are not searched by name unless the tree is under an xxx directory, --all still checks them
+    check = chk.CheckLicense(False)
+    names = [package_name for package_name, version in packages
+             if check.lookup_package_index(check.current_dir, package_name) is not None]
+    results = []
+
+    def find_dirs(state):
+        check = chk.CheckLicense(False)
+        for package_name in names:
+            check.find_dir(check.current_dir, package_name)
+    results.append(run_benchmark('CheckLicense.find_dir', find_dirs, repeat))
+
+    check = chk.CheckLicense(False)
+    package_dirs = [check.find_dir(check.current_dir, package_name) for package_name in names]
+
+    def parse_makefiles(state):
+        for package_name, package_dir in zip(names, package_dirs):
+            check.parse_makefile({'package_name': package_name, 'package_root_dir': package_dir,
+                                  'root_makefile': False, 'proprietary': False,
+                                  'license_types': '', 'license_file_names': '', 'contains_gpl': False,
+                                  'source_file': '', 'source_prefix': ''})
+    results.append(run_benchmark('CheckLicense.parse_makefile', parse_makefiles, repeat))
+
+    for jobs in [1, 4]:
+        results.append(run_benchmark('CheckLicense.check_license_info jobs=%d' % jobs,
+                                     lambda state: chk.CheckLicense(False).check_license_info(names, jobs), repeat))
+
+    index_file = os.path.join(cache_dir, 'index.json')
+    cache_file = os.path.join(cache_dir, 'results.json')
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        chk.CheckLicense(False, index_file, cache_file).check_license_info(names)
+    results.append(run_benchmark('CheckLicense.check_license_info cached',
+                                 lambda state: chk.CheckLicense(False, index_file, cache_file).check_license_info(names),
+                                 repeat))
+    results.append(run_benchmark('CheckLicense.check_all_packages jobs=4',
+                                 lambda state: chk.CheckLicense(False).check_all_packages(4), repeat))
+    os.chdir(work_dir)
+    return results
+
+
+def benchmark_prepare_release(work_dir, packages, repeat):
+    release = load_script(prepare_release_path, 'prepare_gpl_release')
+    release.opts = release_opts(work_dir)
+    tree_dir = os.path.join(work_dir, 'tree')
+    mirror_dir = os.path.join(work_dir, 'mirror')
+    package_list_dir = release.opts.package_list_dir
+    results = []
+
+    def find_tarballs(state):
+        tarball_index = release.index_tarballs(mirror_dir)
+        for package_name, version in packages:
+            release.find_tarball(tarball_index, package_name, version)
+    results.append(run_benchmark('find_tarball (find_file_regex)', find_tarballs, repeat))
+
+    results.append(run_benchmark('find_tarballs_to_keep (delete_tarballs)',
+                                 lambda state: release.find_tarballs_to_keep(tree_dir, mirror_dir, package_list_dir),
+                                 repeat))
+
+    def setup_remove():
+        copy_dir = copy_release_tree(work_dir, 'remove')
+        shutil.copytree(os.path.join(work_dir, 'scripts'), os.path.join(copy_dir, 'xxx_scripts'))
+        tarball_dir = os.path.join(copy_dir, 'tarballs')
+        os.makedirs(tarball_dir)
+        for file in os.scandir(mirror_dir):
+            os.link(file.path, os.path.join(tarball_dir, file.name))
+        release.target_config_tables.clear()
+        return copy_dir
+
+    def remove(copy_dir):
+        release.remove_files(copy_dir, os.path.join(copy_dir, 'xxx/chipcode'),
+                             os.path.join(copy_dir, 'xxx_scripts'), os.path.join(copy_dir, 'tarballs'))
+    results.append(run_benchmark('remove_files', remove, repeat, setup_remove))
+
+    if not os.path.isdir(os.path.join(work_dir, 'scripts.git')):
+        print('git not found, end to end release skipped', file=sys.stderr)
+        return results
+
+    for mode in ['in place', 'stream']:
+        def setup_release():
+            copy_dir = copy_release_tree(work_dir, 'release-src')
+            out_dir = os.path.join(work_dir, 'out')
+            if os.path.exists(out_dir):
+                shutil.rmtree(out_dir)
+            os.makedirs(out_dir)
+            args = [sys.executable, prepare_release_path, 'local', '--src', copy_dir, '--dest', out_dir,
+                    '--mirror', mirror_dir, '--scripts-url', 'file://' + os.path.join(work_dir, 'scripts.git'),
+                    '--compress-level', '1', package_list_dir]
+            if mode == 'stream':
+                args.insert(2, '--stream')
+            return args
+
+        def run_release(args):
+            subprocess.run(args, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        results.append(run_benchmark('end to end local release %s' % mode, run_release, repeat, setup_release))
+
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', '-C', script_dir, 'rev-parse', 'HEAD'], stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL, check=True, universal_newlines=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def parse_program_arguments():
+    """
+    Uses argparse to display help text
+    """
+    parser = argparse.ArgumentParser(description='Use xxx-benchmark to time the license checker and the gpl release script on a synthetic tree')
+    parser.add_argument('--packages', '-p', action='store', type=int, dest='packages', default=500,
+                        help='number of packages in the tree (default: 500)')
+    parser.add_argument('--vendored-files', action='store', type=int, dest='vendored_files', default=20,
+                        help='files in each vendored src/ directory (default: 20)')
+    parser.add_argument('--vendored-ratio', action='store', type=float, dest='vendored_ratio', default=0.3,
+                        help='share of packages that carry their sources (default: 0.3)')
+    parser.add_argument('--nested-ratio', action='store', type=float, dest='nested_ratio', default=0.2,
+                        help='share of packages with a nested Makefile (default: 0.2)')
+    parser.add_argument('--git-ratio', action='store', type=float, dest='git_ratio', default=0.1,
+                        help='share of packages with a .git directory (default: 0.1)')
+    parser.add_argument('--feeds-ratio', action='store', type=float, dest='feeds_ratio', default=0.3,
+                        help='share of packages under feeds/ (default: 0.3)')
+    parser.add_argument('--xxx-ratio', action='store', type=float, dest='xxx_ratio', default=0.1,
+                        help='share of packages under xxx/feeds (default: 0.1)')
+    parser.add_argument('--mirror-decoys', action='store', type=int, dest='mirror_decoys', default=9,
+                        help='extra tarball versions per package in the mirror (default: 9)')
+    parser.add_argument('--chipcode-versions', action='store', type=int, dest='chipcode_versions', default=6,
+                        help='chipcode version directories (default: 6)')
+    parser.add_argument('--targets', action='store', type=int, dest='targets', default=12,
+                        help='buildap targets with an xxx_config.py (default: 12)')
+    parser.add_argument('--seed', action='store', type=int, dest='seed', default=0,
+                        help='random seed, the same seed generates the same tree (default: 0)')
+    parser.add_argument('--repeat', '-r', action='store', type=int, dest='repeat', default=3,
+                        help='runs of each benchmark (default: 3)')
+    parser.add_argument('--only', action='store', choices=['chk-license', 'prepare-release'], dest='only', default='',
+                        help='only benchmark one of the scripts')
+    parser.add_argument('--work-dir', action='store', dest='work_dir', default='',
+                        help='directory for the generated tree, kept after the run (default: a temporary directory)')
+    parser.add_argument('--generate-only', action='store_true', dest='generate_only_bol', default=False,
+                        help='only generate the synthetic tree in --work-dir')
+    parser.add_argument('--output', '-o', action='store', dest='output', default='',
+                        help='file the JSON results are written to (default: stdout)')
+    return parser.parse_args()
+
+
+###### Main ######
+if __name__ == "__main__":
+
+    opts = parse_program_arguments()
+
+    work_dir = os.path.abspath(opts.work_dir) if opts.work_dir else tempfile.mkdtemp(prefix='xxx-benchmark-')
+    if os.path.exists(os.path.join(work_dir, 'tree')):
+        print('%s already has a tree, use an empty --work-dir' % work_dir, file=sys.stderr)
+        sys.exit(1)
+    os.makedirs(work_dir, exist_ok=True)
+    start = time.perf_counter()
+    packages = make_tree(work_dir, opts)
+    print('generated %d packages in %s in %.1fs' % (len(packages), work_dir, time.perf_counter() - start), file=sys.stderr)
+    if opts.generate_only_bol:
+        sys.exit(0)
+
+    cache_dir = tempfile.mkdtemp(prefix='xxx-benchmark-cache-')
+    results = []
+    try:
+        if opts.only in ['', 'chk-license']:
+            results += benchmark_chk_license(work_dir, packages, opts.repeat, cache_dir)
+        if opts.only in ['', 'prepare-release']:
+            results += benchmark_prepare_release(work_dir, packages, opts.repeat)
+    finally:
+        shutil.rmtree(cache_dir)
+        if not opts.work_dir:
+            shutil.rmtree(work_dir)
+
+    report = {'commit': git_commit(), 'python': sys.version.split()[0],
+              'params': dict((key, value) for key, value in vars(opts).items() if key not in ['output', 'work_dir']),
+              'results': results}
+    if opts.output:
+        with open(opts.output, 'w') as write_file:
+            json.dump(report, write_file, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print('')
@@ -2,158 +2,723 @@
 # Copyright (C) 2022 Ben Pepe
 import os
 from shutil import rmtree
-import glob
 import argparse
-import re
 import sys
+import shutil
+import subprocess
+import tempfile
+import tarfile
+import io
+import lzma
+import time
+import random
+import ast
+import threading
+import json
+import atexit
+import hashlib
+import queue
+from contextlib import contextmanager, nullcontext
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 ###### Variables ######
-###### Functions ######
+default_mirror = 'rsync://xxx.yyy.zzz.co.jp:/tarballs'
+default_repo_url = 'git@git-xxx.co.jp:xxx/xxx.git'
+default_scripts_url = 'git@git-xxx.co.jp:xxx/xxx_scripts.git'
+archive_suffix_list = ['.tar.gz', '.tar.xz', '.tar.bz2', '.tar.zst', '.tar.lz', '.tar', '.tgz', '.tbz2', '.txz', '.zip', '.gz', '.xz', '.bz2']
+# Memory in MiB xz needs to compress at each preset level
+xz_level_memory = [3, 9, 17, 32, 48, 94, 94, 186, 370, 674]
+# Dictionary size in MiB of each preset level, blocks are 3 dictionaries like xz -T
+xz_level_dict_size = [0.25, 1, 2, 4, 4, 8, 8, 16, 32, 64]
+# Lowest and highest --compress-level of each format
+compress_level_range = {'xz': (0, 9), 'zstd': (1, 22)}
+# Bytes read at a time from files added to or read from release archives
+archive_block_size = 1024 * 1024
+# Parsed xxx_config.py files, {zzz_dir: {target: {key: value}}}
+target_config_tables = {}
+target_config_lock = threading.Lock()
+###### Classes ######
+
+
+class ParallelXzWriter(object):
+    """
+    File like object that compresses what is written to it in independent
+    xz blocks on a thread pool. Each block is a complete xz stream and
+    concatenated streams are read by xz, tar -J and the lzma module.
+    At most two blocks per thread are held in memory
+    """
+    def __init__(self, fileobj, level=6, threads=1, block_size=None):
+        self.fileobj = fileobj
+        self.level = level
+        self.block_size = block_size or int(xz_level_dict_size[level] * 3 * 1024 * 1024)
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+        self.max_pending = threads * 2
+        self.pending = deque()
+        self.buffer = bytearray()
+        self.blocks = 0
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= self.block_size:
+            block = bytes(self.buffer[:self.block_size])
+            del self.buffer[:self.block_size]
+            self.submit(block)
+        return len(data)
+
+    def submit(self, block):
+        # lzma releases the GIL while compressing so blocks run in parallel
+        self.pending.append(self.executor.submit(lzma.compress, block, format=lzma.FORMAT_XZ, preset=self.level))
+        self.blocks += 1
+        while len(self.pending) > self.max_pending:
+            self.fileobj.write(self.pending.popleft().result())
+
+    def close(self):
+        if self.buffer or not self.blocks:
+            self.submit(bytes(self.buffer))
+            self.buffer = bytearray()
+        while self.pending:
+            self.fileobj.write(self.pending.popleft().result())
+        self.executor.shutdown()
+        self.fileobj.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class ZstdWriter(object):
+    """
+    File like object that pipes what is written to it through zstd -T,
+    the compressed output is copied to fileobj
+    """
+    def __init__(self, fileobj, level=3, threads=1):
+        self.fileobj = fileobj
+        args = ['zstd', '-q', '-c', '-T%d' % threads, '-%d' % level]
+        if level > 19:
+            args.insert(1, '--ultra')
+        self.process = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.copier = threading.Thread(target=self.copy_output)
+        self.copier.start()
+
+    def copy_output(self):
+        for block in iter(lambda: self.process.stdout.read(archive_block_size), b''):
+            self.fileobj.write(block)
+
+    def write(self, data):
+        self.process.stdin.write(data)
+        return len(data)
+
+    def close(self):
+        self.process.stdin.close()
+        self.copier.join()
+        self.fileobj.close()
+        if self.process.wait() != 0:
+            raise IOError("zstd exited with %d" % self.process.returncode)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class DigestFile(object):
+    """
+    File like object that hashes the data written to or read from fileobj
+    """
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.sha = hashlib.sha256()
+        self.size = 0
 
+    def write(self, data):
+        self.sha.update(data)
+        self.size += len(data)
+        return self.fileobj.write(data)
 
-def find_line(path, substring):
-    with open(path, 'r') as f:
-        string = f.read()
-        string = string.splitlines()
-        for line in string:
-            if substring in line:
-                return line
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.sha.update(data)
+        self.size += len(data)
+        return data
 
+    def close(self):
+        self.fileobj.close()
 
-def str_to_regex_str(input_str):
-    regex_string = ''
-    special_char_list = ['.', '\\', '+', '?', '$', '^',
-                         '(', ')', '[', ']', '{', '}', '*', '|']
-    # Convert special character in regext to literal's
-    for i in range(0, len(input_str)):
-        if input_str[i] in special_char_list:
-            regex_string += '\\' + input_str[i]
-        else:
-            regex_string += input_str[i]
 
-    return regex_string
+class LaneReader(object):
+    """
+    File like object that passes what is read from fileobj to the task
+    hashing it, close marks the end of the member
+    """
+    def __init__(self, fileobj, lane):
+        self.fileobj = fileobj
+        self.lane = lane
+        self.closed = False
 
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        if data:
+            self.lane.put(data)
+        return data
 
-def find_file_regex(package_name, version):
-    regex_string = ''
-    regex_string += str_to_regex_str(package_name)
-    regex_string += '(\_|\W)'
-    regex_string += str_to_regex_str(version)
-    regex_expression = ('^%s.*$' % regex_string)
-    for file in os.scandir(tarball_dir):
-        if (re.match(regex_expression, file.name) and
-                os.path.isfile(os.path.join(tarball_dir, file.name))):
-            return [file.name]
+    def close(self):
+        # The hashing task waits for the end of the member, it is marked once even on errors
+        if not self.closed:
+            self.closed = True
+            self.lane.put(None)
 
-    return ''
 
+class TeeReader(object):
+    """
+    File like object that writes what is read from fileobj to output
+    """
+    def __init__(self, fileobj, output):
+        self.fileobj = fileobj
+        self.output = output
 
-def get_current_version(zzz_dir, key_word):
-    current_version = []
-    for dir in os.scandir(os.path.join(zzz_dir, 'buildap/target')):
-        target_path = 'buildap/target/' + dir.name + '/xxx_config.py'
-        version_find = find_line(os.path.join(zzz_dir, target_path), key_word)
-        version_find = version_find.split('=')[1].strip("'")
-        if version_find not in current_version:
-            current_version.append(version_find)
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.output.write(data)
+        return data
 
-    return current_version
+    def drain(self):
+        for block in iter(lambda: self.read(archive_block_size), b''):
+            pass
 
 
-def delete_not_in_list(target_dir, file_list):
-    for file in os.scandir(target_dir):
-        if file.name not in file_list and os.path.isdir(os.path.join(target_dir, file.name)):
-            if opts.verbose_bol:
-                print("Removing ", file.name)
-            rmtree(os.path.join(target_dir, file.name))
+class MemberHasher(object):
+    """
+    Hashes archive members on a thread pool while they are read for the
+    archive, so no file is read twice. Each member is hashed by one task
+    fed through a bounded queue and hashlib releases the GIL, so hashing
+    overlaps reading and compressing. Records are kept in archive order
+    """
+    def __init__(self, threads):
+        self.executor = ThreadPoolExecutor(max_workers=max(1, threads))
+        self.members = []
+        self.reader = None
+
+    def add(self, tarinfo, fileobj=None, data=None):
+        """
+        Records a member, for regular files returns a LaneReader that must
+        be read to the end of the member and closed, also when reading fails
+        """
+        record = member_record(tarinfo)
+        if data is not None:
+            record['sha256'] = hashlib.sha256(data).hexdigest()
+            self.members.append((record, None))
+            return None
+        if not tarinfo.isreg():
+            self.members.append((record, None))
+            return None
+        # Members are added one at a time, every earlier lane is closed so its task can finish
+        lane = queue.Queue(maxsize=16)
+        self.members.append((record, self.executor.submit(hash_lane, lane)))
+        self.reader = LaneReader(fileobj, lane)
+        return self.reader
+
+    def records(self):
+        records = []
+        for record, future in self.members:
+            if future is not None:
+                record['sha256'], size = future.result()
+                if size != record['size']:
+                    raise IOError("%s changed while it was archived" % record['name'])
+            records.append(record)
+        self.executor.shutdown()
+
+        return records
+
+    def close(self):
+        # After an error the open lane is closed so no task waits for it and the threads can exit
+        if self.reader is not None:
+            self.reader.close()
+        self.executor.shutdown(cancel_futures=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class Tracer(object):
+    """
+    Records phases with their wall and cpu time, and counters, and writes
+    them as a Chrome trace-event file. The file is plain JSON, counters
+    are also kept under otherData
+    """
+    enabled = True
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.events = []
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name, **args):
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        thread_cpu = time.thread_time()
+        children = os.times()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            # cpu_ms includes every thread of the process, thread_cpu_ms only the one running the phase
+            # children_cpu_ms is git, rsync, tar and zstd, it is only counted once they are waited for
+            args['cpu_ms'] = (time.process_time() - cpu) * 1000
+            args['thread_cpu_ms'] = (time.thread_time() - thread_cpu) * 1000
+            args['children_cpu_ms'] = (sum(os.times()[2:4]) - sum(children[2:4])) * 1000
+            event = {'name': name, 'ph': 'X', 'pid': os.getpid(), 'tid': threading.get_ident(),
+                     'ts': (wall - self.start) * 1000000, 'dur': (end - wall) * 1000000, 'args': args}
+            with self.lock:
+                self.events.append(event)
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def write(self, trace_file):
+        end = (time.perf_counter() - self.start) * 1000000
+        events = list(self.events)
+        for name, value in sorted(self.counters.items()):
+            events.append({'name': name, 'ph': 'C', 'pid': os.getpid(), 'ts': end, 'args': {name: value}})
+        trace = {'traceEvents': events, 'displayTimeUnit': 'ms',
+                 'otherData': {'command': ' '.join(sys.argv), 'wall_s': end / 1000000,
+                               'cpu_s': time.process_time(), 'counters': self.counters}}
+        with open(trace_file, 'w') as write_file:
+            json.dump(trace, write_file, indent=1)
+
+
+class NullTracer(object):
+    """
+    Used when tracing is off, phases and counters cost one call
+    """
+    enabled = False
+
+    def phase(self, name, **args):
+        return nullcontext()
+
+    def count(self, name, value=1):
+        pass
+
+
+# Replaced by a Tracer when --trace is given
+tracer = NullTracer()
+
+
+class PackageEntry(object):
+    """
+    One package of package-full-list, slots keep long lists small
+    """
+    __slots__ = ('source_name', 'name', 'version', 'proprietary', 'line')
+
+    def __init__(self, source_name, name, version, proprietary, line):
+        self.source_name = source_name
+        self.name = name
+        self.version = version
+        self.proprietary = proprietary
+        # Line of the source name in package-full-list
+        self.line = line
+
+
+###### Functions ######
 
-        elif file.name not in file_list and os.path.isfile(os.path.join(target_dir, file.name)):
-            if opts.verbose_bol:
-                print("Removing ", file.name)
-            os.remove(os.path.join(target_dir, file.name))
+
+def hash_lane(lane):
+    # Returns (sha256, size) of the blocks put in lane until None
+    sha = hashlib.sha256()
+    size = 0
+    for block in iter(lane.get, None):
+        sha.update(block)
+        size += len(block)
+
+    return sha.hexdigest(), size
+
+
+def hash_archive_members(tar, hasher):
+    # Reads every member of a tarfile opened as a stream so hasher records it
+    for member in tar:
+        reader = hasher.add(member, tar.extractfile(member) if member.isreg() else None)
+        if reader:
+            try:
+                for block in iter(lambda: reader.read(archive_block_size), b''):
+                    pass
+            finally:
+                reader.close()
 
     return
 
 
-def delete_git(zzz_dir):
-    for root, dirs, files in os.walk(zzz_dir):
-        for target in glob.glob(os.path.join(root, ".git*")):
-            if os.path.isdir(target):
-                if opts.verbose_bol:
-                    print("Removing ", target)
-                rmtree(target)
+def member_record(tarinfo):
+    # gettarinfo keeps the file type bits, tar only stores the permissions
+    record = {'name': tarinfo.name, 'mode': '%04o' % (tarinfo.mode & 0o7777)}
+    if tarinfo.isreg():
+        record.update(type='file', size=tarinfo.size)
+    elif tarinfo.isdir():
+        record['type'] = 'dir'
+    elif tarinfo.issym():
+        record.update(type='symlink', linkname=tarinfo.linkname)
+    elif tarinfo.islnk():
+        record.update(type='hardlink', linkname=tarinfo.linkname)
+    else:
+        record['type'] = 'other'
+
+    return record
+
+
+def manifest_path(archive_path):
+    return archive_path + '.manifest.json'
+
 
-            elif os.path.isfile(target):
-                if opts.verbose_bol:
-                    print("Removing ", target)
-                os.remove(target)
+def write_manifest(archive_path, release_name, archive_digest, members, tarballs):
+    """
+    Writes the manifest published next to the release archive: every
+    member with its size and SHA-256, the tarballs kept and why, and the
+    archive's own SHA-256. Only tarballs written to the archive are listed
+    as kept, kept tarballs that are not in it are printed and listed apart
+    """
+    tarball_prefix = release_name + '/tarballs/'
+    archived = set(record['name'][len(tarball_prefix):] for record in members
+                   if record['name'].startswith(tarball_prefix) and record['type'] in ['file', 'hardlink'])
+    missing = sorted(name for name in tarballs if name not in archived)
+    for name in missing:
+        print("Kept tarball is not in the archive: ", name)
+    manifest = {'release': release_name,
+                'archive': os.path.basename(archive_path),
+                'archive_sha256': archive_digest.sha.hexdigest(),
+                'archive_size': archive_digest.size,
+                'members': members,
+                'tarballs': [{'name': name, 'reasons': tarballs[name]} for name in sorted(tarballs) if name in archived],
+                'missing_tarballs': [{'name': name, 'reasons': tarballs[name]} for name in missing]}
+    with open(manifest_path(archive_path), 'w') as write_file:
+        json.dump(manifest, write_file, indent=1)
+        write_file.write('\n')
 
     return
 
 
-def delete_sensitive_docs(zzz_dir):
-    directory_list = ['xxx-tools', 'buildap', 'docker']
-    file_list = ['README.md', 'Readme.txt']
-    for dir_buff in directory_list:
-        dir_buff = os.path.join(zzz_dir, dir_buff)
-        for file in file_list:
-            file = os.path.join(dir_buff, file)
-            if os.path.isfile(file):
-                if opts.verbose_bol:
-                    print("Removing ", file)
-                os.remove(file)
+def add_archive_member(tar, hasher, path, arcname, data=None):
+    # tar.add with the member hashed as it is read
+    tarinfo = tar.gettarinfo(path, arcname)
+    if data is not None:
+        tarinfo.size = len(data)
+        if hasher:
+            hasher.add(tarinfo, data=data)
+        tar.addfile(tarinfo, io.BytesIO(data))
+    elif tarinfo.isreg():
+        with open(path, 'rb') as read_file:
+            reader = hasher.add(tarinfo, read_file) if hasher else read_file
+            try:
+                tar.addfile(tarinfo, reader)
+            finally:
+                if hasher:
+                    reader.close()
+    else:
+        if hasher:
+            hasher.add(tarinfo)
+        tar.addfile(tarinfo)
 
     return
 
 
-def delete_xxx(zzz_dir, chipcode_dir):
-    key_word = 'xxx_chipcode_ver'
-    xxx_ver = get_current_version(zzz_dir, key_word)
-    for dir in os.scandir(chipcode_dir):
-        if dir.name not in xxx_ver and os.path.isdir(os.path.join(chipcode_dir, dir.name)):
-            if opts.verbose_bol:
-                print("Removing ", dir.name)
-            rmtree(os.path.join(chipcode_dir, dir.name))
+def verify_archive(archive_path, manifest_file):
+    """
+    Reads the archive as a stream, nothing is extracted, and returns the
+    differences with its manifest
+    """
+    with open(manifest_file, 'r') as read_file:
+        manifest = json.load(read_file)
+    raw = DigestFile(open(archive_path, 'rb'))
+    process = None
+    if archive_path.endswith('.zst'):
+        process = subprocess.Popen(['zstd', '-q', '-d', '-c'], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+        def feed():
+            try:
+                for block in iter(lambda: raw.read(archive_block_size), b''):
+                    process.stdin.write(block)
+                process.stdin.close()
+            except (IOError, OSError):
+                # zstd stopped reading, its exit status is reported
+                pass
+        feeder = threading.Thread(target=feed)
+        feeder.start()
+        stream = process.stdout
+    else:
+        # LZMAFile reads the concatenated streams ParallelXzWriter writes
+        stream = lzma.open(raw)
+    try:
+        with tracer.phase('verify', archive=archive_path), MemberHasher(opts.jobs) as hasher:
+            with tarfile.open(fileobj=stream, mode='r|') as tar:
+                hash_archive_members(tar, hasher)
+            # Padding after the last member, the archive digest covers the whole file
+            for block in iter(lambda: stream.read(archive_block_size), b''):
+                pass
+            if process:
+                feeder.join()
+                if process.wait() != 0:
+                    return ["%s: archive is truncated or corrupt, zstd exited with %d"
+                            % (os.path.basename(archive_path), process.returncode)]
+            members = hasher.records()
+    except (tarfile.TarError, EOFError, lzma.LZMAError) as e:
+        return ["%s: archive is truncated or corrupt: %s" % (os.path.basename(archive_path), e)]
+    finally:
+        if process:
+            # Stops zstd when the archive could not be read to the end
+            process.kill()
+            feeder.join()
+            process.wait()
+        raw.close()
+
+    problems = []
+    if raw.sha.hexdigest() != manifest['archive_sha256'] or raw.size != manifest['archive_size']:
+        problems.append("%s: archive SHA-256 or size differs from the manifest" % os.path.basename(archive_path))
+    expected = dict((record['name'], record) for record in manifest['members'])
+    for record in members:
+        expected_record = expected.pop(record['name'], None)
+        if expected_record is None:
+            problems.append("%s: not in the manifest" % record['name'])
+        elif expected_record != record:
+            fields = sorted(key for key in set(record) | set(expected_record) if record.get(key) != expected_record.get(key))
+            problems.append("%s: %s differ" % (record['name'], ', '.join(fields)))
+    for name in sorted(expected):
+        problems.append("%s: missing from the archive" % name)
+
+    return problems
+
+
+def strip_archive_suffix(file_name):
+    for suffix in archive_suffix_list:
+        if file_name.endswith(suffix):
+            return file_name[:-len(suffix)]
+    return file_name
+
+
+def index_tarball_names(file_names):
+    """
+    Returns {name_prefix: [(rest, file_name)]} for the tarball file names
+    Every "_" or non word character in a file name splits it into a name
+    prefix and the rest that starts with the version
+    """
+    tarball_index = {}
+    for file_name in file_names:
+        for i, char in enumerate(file_name):
+            if char == '_' or not char.isalnum():
+                tarball_index.setdefault(file_name[:i], []).append((file_name[i + 1:], file_name))
 
-        elif dir.name not in xxx_ver and os.path.isfile(os.path.join(chipcode_dir, dir.name)):
-            if opts.verbose_bol:
-                print("Removing ", dir.name)
-            os.remove(os.path.join(chipcode_dir, dir.name))
+    return tarball_index
 
-        else:
-            for dir in xxx_ver:
-                current_dir = os.path.join(chipcode_dir, dir)
-                if opts.verbose_bol:
-                    print("Removing files from ", current_dir)
 
-                chipcode_list = ['codexxxxx']
-                delete_not_in_list(current_dir, chipcode_list)
+def index_tarballs(tarball_dir):
+    # Scans tarball_dir once
+    return index_tarball_names(file.name for file in os.scandir(tarball_dir) if file.is_file())
 
-    return
+
+def has_tarball(tarball_index, file_name):
+    # Every tarball is listed under the name prefix up to its first separator
+    for i, char in enumerate(file_name):
+        if char == '_' or not char.isalnum():
+            return any(name == file_name for rest, name in tarball_index.get(file_name[:i], []))
+
+    return False
+
+
+def find_tarball(tarball_index, package_name, version):
+    """
+    Returns the tarballs named <package_name><separator><version>...
+    More than one name is returned when the match is ambiguous
+    """
+    matches = [file_name for rest, file_name in tarball_index.get(package_name, [])
+               if rest.startswith(version)]
+    if len(matches) > 1 and version:
+        # Prefer foo-1.2.tar.gz over foo-1.2.1.tar.gz for version 1.2
+        exact = [file_name for file_name in matches
+                 if not any(c.isdigit() for c in strip_archive_suffix(file_name)[len(package_name) + 1 + len(version):])]
+        if exact:
+            matches = exact
+
+    return sorted(set(matches))
 
 
-def delete_tarballs(zzz_dir, tarball_dir):
-    package_list = []
+def parse_target_config(config_path):
+    """
+    Returns {key: value} for the top level assignments of literal values
+    in an xxx_config.py file
+    """
+    with open(config_path, 'r') as read_file:
+        tree = ast.parse(read_file.read(), config_path)
+    config = {}
+    for node in tree.body:
+        if not isinstance(node, ast.Assign):
+            continue
+        try:
+            value = ast.literal_eval(node.value)
+        except ValueError:
+            # Computed values are not used by this script
+            continue
+        for target in node.targets:
+            if isinstance(target, ast.Name):
+                config[target.id] = value
+
+    return config
+
+
+def load_target_configs(zzz_dir):
+    """
+    Reads every buildap/target/<target>/xxx_config.py once and returns
+    {target: {key: value}}. Tables are kept per zzz_dir for every stage
+    """
+    zzz_dir = os.path.normpath(zzz_dir)
+    with target_config_lock:
+        if zzz_dir in target_config_tables:
+            return target_config_tables[zzz_dir]
+        target_configs = {}
+        target_dir = os.path.join(zzz_dir, 'buildap/target')
+        for dir in sorted(os.scandir(target_dir), key=lambda entry: entry.name):
+            if not dir.is_dir():
+                continue
+            config_path = os.path.join(target_dir, dir.name, 'xxx_config.py')
+            if not os.path.isfile(config_path):
+                print("Target %s has no xxx_config.py" % dir.name)
+                continue
+            try:
+                target_configs[dir.name] = parse_target_config(config_path)
+            except (SyntaxError, ValueError) as e:
+                print("Can not parse %s: %s" % (config_path, e))
+                target_configs[dir.name] = {}
+        target_config_tables[zzz_dir] = target_configs
+
+    return target_configs
+
+
+def get_current_version(zzz_dir, key_word):
+    """
+    Returns the distinct values of key_word over all targets, targets
+    that do not set it are reported and skipped
+    """
+    current_version = []
+    for target, config in load_target_configs(zzz_dir).items():
+        if key_word not in config:
+            print("Target %s does not set %s in xxx_config.py" % (target, key_word))
+            continue
+        version_find = str(config[key_word])
+        if version_find not in current_version:
+            current_version.append(version_find)
+
+    return current_version
+
+
+def valid_package_entry(package_source_name, package_name, version, proprietary):
+    # The source name may be empty, the proprietary flag lines the groups up
+    if not package_name or proprietary not in ['0', '1']:
+        return False
+    return not any(len(field.split()) > 1 or field != field.strip()
+                   for field in [package_source_name, package_name, version])
+
+
+def report_malformed_lines(package_list_dir, first_line, skipped_lines):
+    print("%s:%d-%d: malformed package entry skipped: %s" % (package_list_dir, first_line, first_line + len(skipped_lines) - 1,
+                                                            ' | '.join(skipped_lines)))
+
+
+def iter_package_list(package_list_dir):
+    """
+    Yields a PackageEntry for every group of four lines in package-full-list:
+    source name, package name, version and proprietary flag. Malformed
+    groups, such as those shifted by a stray blank line, are reported with
+    their line numbers and skipped a line at a time until the groups line
+    up again. Blank lines at the end of the list are ignored. Once the list
+    is read, malformed groups end the release unless --allow-malformed is given
+    """
+    window = deque()
+    first_line = 1
+    skipped_lines = []
+    malformed = 0
+    with open(package_list_dir, 'r') as read_file:
+        for line in read_file:
+            window.append(line.rstrip('\r\n'))
+            if len(window) < 4:
+                continue
+            if valid_package_entry(*window):
+                if skipped_lines:
+                    report_malformed_lines(package_list_dir, first_line - len(skipped_lines), skipped_lines)
+                    malformed += 1
+                    skipped_lines = []
+                yield PackageEntry(window[0], window[1], window[2], window[3], first_line)
+                window.clear()
+                first_line += 4
+            else:
+                skipped_lines.append(window.popleft())
+                first_line += 1
+    # Lines left at the end do not make a whole group
+    start_line = first_line - len(skipped_lines)
+    skipped_lines += window
+    while skipped_lines and not skipped_lines[-1]:
+        skipped_lines.pop()
+    if skipped_lines:
+        report_malformed_lines(package_list_dir, start_line, skipped_lines)
+        malformed += 1
+    if malformed and not opts.allow_malformed_bol:
+        # The packages skipped would be missing from the release
+        print("%s: %d malformed package entries, fix the list or use --allow-malformed to release without them"
+              % (package_list_dir, malformed))
+        sys.exit(1)
+
+
+def resolve_tarballs(zzz_dir, tarball_index, package_entries):
+    """
+    Returns {tarball name: [reasons]} of the tarballs to keep for the non
+    proprietary packages in package_entries and the current toolchains.
+    Ambiguous and unresolved packages are printed
+    """
+    package_list = {}
+    unresolved_list = []
+    ambiguous_list = []
+    for entry in package_entries:
+        if entry.proprietary != '1':
+            if entry.source_name:
+                if not has_tarball(tarball_index, entry.source_name):
+                    unresolved_list.append('%s %s (line %d)' % (entry.name, entry.version, entry.line))
+                else:
+                    package_list.setdefault(entry.source_name, []).append(
+                        'source of %s %s (line %d)' % (entry.name, entry.version, entry.line))
+            else:
+                tarballs = find_tarball(tarball_index, entry.name, entry.version)
+                if not tarballs:
+                    unresolved_list.append('%s %s (line %d)' % (entry.name, entry.version, entry.line))
+                elif len(tarballs) > 1:
+                    ambiguous_list.append('%s %s (line %d): %s' % (entry.name, entry.version, entry.line, ', '.join(tarballs)))
+                for tarball in tarballs:
+                    package_list.setdefault(tarball, []).append(
+                        '%s %s (line %d)%s' % (entry.name, entry.version, entry.line, ', ambiguous' if len(tarballs) > 1 else ''))
+    key_word = 'toolchain_pack'
+    for toolchain in get_current_version(zzz_dir, key_word):
+        tarballs = find_tarball(tarball_index, toolchain, '')
+        if not tarballs:
+            unresolved_list.append(toolchain)
+        elif len(tarballs) > 1:
+            ambiguous_list.append('%s: %s' % (toolchain, ', '.join(tarballs)))
+        for tarball in tarballs:
+            package_list.setdefault(tarball, []).append('toolchain %s' % toolchain)
+    # Ambiguous matches are all kept, a missing source is worse than an extra one
+    for package in ambiguous_list:
+        print("Ambiguous tarballs, keeping all for ", package)
+    for package in unresolved_list:
+        print("No tarball found for ", package)
+
+    return package_list
+
+
+def find_tarballs_to_keep(zzz_dir, tarball_dir, package_list_dir):
     try:
-        with open(opts.package_list_dir, 'r') as read_file:
-            while True:
-                # Get package data
-                package_source_name = read_file.readline().rstrip('\n')
-                package_name = read_file.readline().rstrip('\n')
-                version = read_file.readline().rstrip('\n')
-                proprietary = read_file.readline().rstrip('\n')
-                # If end of file then exit while loop
-                if not package_name:
-                    break
-                if proprietary != '1':
-                    if package_source_name:
-                        package_list.append(package_source_name)
-                    else:
-                        package_list.append(find_file_regex(package_name, version))
-        key_word = 'toolchain_pack'
-        for toolchain in get_current_version(zzz_dir, key_word):
-            package_list += find_file_regex(toolchain, '')
-        delete_not_in_list(tarball_dir, package_list)
-        return
+        # Entries are resolved as they are read, the list is never held in memory
+        return resolve_tarballs(zzz_dir, index_tarballs(tarball_dir), iter_package_list(package_list_dir))
     except IOError as e:
         print ("I/O error({0}): {1}".format(e.errno, e.strerror))
         raise
@@ -162,7 +727,7 @@ def delete_tarballs(zzz_dir, tarball_dir):
         raise
 
 
-def edit_docker_config(script_dir):
+def read_docker_config(script_dir):
     buff = []
     with open(os.path.join(script_dir, 'docker_config.py'), "r") as read_file:
         for line in read_file:
@@ -172,44 +737,385 @@ def edit_docker_config(script_dir):
             else:
                 buff.append(line)
 
+    return buff
+
+
+def edit_docker_config(script_dir):
+    buff = read_docker_config(script_dir)
+
     with open(os.path.join(script_dir, 'docker_config.py'), "w") as write_file:
         write_file.writelines(buff)
 
     return
 
 
+def release_rules(zzz_dir, chipcode_dir, script_dir, tarball_dir, package_list_dir):
+    """
+    Returns (keep_lists, remove_lists) used to decide what is not to be publicly released
+    keep_lists: {dir: (names kept, reason)}, everything else in dir is removed
+    The tarballs kept map each name to the reasons it is kept
+    remove_lists: {dir: {name: reason}}
+    """
+    zzz_dir = os.path.normpath(zzz_dir)
+    keep_lists = {}
+    keep_lists[os.path.normpath(script_dir)] = (['buildap', 'buildap.py', 'buildap_docker.py', 'helpers.py', 'docker_user_remap', 'docker_config.py'], 'script')
+    xxx_ver = get_current_version(zzz_dir, 'xxx_chipcode_ver')
+    keep_lists[os.path.normpath(chipcode_dir)] = (xxx_ver, 'chipcode version not in use')
+    for ver in xxx_ver:
+        keep_lists[os.path.normpath(os.path.join(chipcode_dir, ver))] = (['codexxxxx'], 'chipcode')
+    if os.path.isdir(tarball_dir):
+        with tracer.phase('tarball filter', package_list=package_list_dir):
+            keep_lists[os.path.normpath(tarball_dir)] = (find_tarballs_to_keep(zzz_dir, tarball_dir, package_list_dir), 'tarball not in package list')
+    remove_lists = {zzz_dir: {'xxxprop': 'proprietary', 'xxxagent': 'proprietary'}}
+    for dir_buff in ['xxx-tools', 'buildap', 'docker']:
+        remove_lists[os.path.join(zzz_dir, dir_buff)] = {'README.md': 'sensitive doc', 'Readme.txt': 'sensitive doc'}
+    # Scripts and tarballs staged outside of the source tree replace the ones in it
+    for staged_dir in [script_dir, tarball_dir]:
+        if os.path.dirname(os.path.normpath(staged_dir)) != zzz_dir:
+            remove_lists[zzz_dir][os.path.basename(staged_dir)] = 'replaced by staged copy'
+
+    return keep_lists, remove_lists
+
+
+def walk_release_tree(root_dir, keep_lists, remove_lists):
+    """
+    Walks root_dir once and yields (entry, is_dir, reason) for every entry
+    reason is None for entries that are released. Removed directories are
+    not descended into
+    """
+    stack = [os.path.normpath(root_dir)]
+    while stack:
+        root = stack.pop()
+        with os.scandir(root) as it:
+            entries = sorted(it, key=lambda entry: entry.name)
+        tracer.count('dirs walked')
+        sub_dirs = []
+        for entry in entries:
+            is_dir = entry.is_dir(follow_symlinks=False)
+            reason = None
+            if entry.name.startswith('.git'):
+                reason = 'git'
+            elif root in keep_lists and entry.name not in keep_lists[root][0]:
+                reason = keep_lists[root][1]
+            elif entry.name in remove_lists.get(root, {}):
+                reason = remove_lists[root][entry.name]
+            yield entry, is_dir, reason
+            if not reason and is_dir:
+                sub_dirs.append(entry.path)
+        stack.extend(reversed(sub_dirs))
+
+
+def release_roots(zzz_dir, script_dir, tarball_dir):
+    # Directories to walk, the staged ones when they are outside of the source tree
+    roots = [zzz_dir]
+    for staged_dir in [script_dir, tarball_dir]:
+        if os.path.dirname(os.path.normpath(staged_dir)) != os.path.normpath(zzz_dir) and os.path.isdir(staged_dir):
+            roots.append(staged_dir)
+
+    return roots
+
+
+def kept_tarballs(keep_lists, tarball_dir):
+    # {tarball name: [reasons]} of the tarballs released
+    return keep_lists.get(os.path.normpath(tarball_dir), ({}, ''))[0]
+
+
+def plan_removals(zzz_dir, chipcode_dir, script_dir, tarball_dir, package_list_dir, rules=None):
+    """
+    Returns [(path, is_dir, reason)] for everything that is not to be publicly released
+    rules are the (keep_lists, remove_lists) of release_rules, computed when not given
+    """
+    keep_lists, remove_lists = rules or release_rules(zzz_dir, chipcode_dir, script_dir, tarball_dir, package_list_dir)
+    plan = []
+    with tracer.phase('plan removals'):
+        for root_dir in release_roots(zzz_dir, script_dir, tarball_dir):
+            for entry, is_dir, reason in walk_release_tree(root_dir, keep_lists, remove_lists):
+                if reason:
+                    plan.append((entry.path, is_dir, reason))
+
+    return plan
+
+
+def write_release_archive(zzz_dir, chipcode_dir, script_dir, tarball_dir, package_list_dir, release_name, archive_path,
+                          compress_threads=None, compress_memory=None):
+    """
+    Writes the release archive straight from the source tree, the removal
+    rules are applied as a filter so nothing in the tree is changed.
+    compress_threads and compress_memory default to the command line options
+    """
+    if compress_threads is None:
+        compress_threads = opts.compress_threads
+    if compress_memory is None:
+        compress_memory = opts.compress_memory
+    keep_lists, remove_lists = release_rules(zzz_dir, chipcode_dir, script_dir, tarball_dir, package_list_dir)
+    docker_config_path = os.path.normpath(os.path.join(script_dir, 'docker_config.py'))
+    with MemberHasher(opts.jobs) if opts.manifest_bol else nullcontext() as hasher:
+        with tracer.phase('archive', archive=archive_path, stream=True), \
+                open_compressed(archive_path, opts.compress_format, opts.compress_level,
+                                compress_threads, compress_memory) as output, \
+                tarfile.open(fileobj=output, mode='w|', copybufsize=archive_block_size) as tar:
+            add_archive_member(tar, hasher, zzz_dir, release_name)
+            for root_dir in release_roots(zzz_dir, script_dir, tarball_dir):
+                root_dir = os.path.normpath(root_dir)
+                arc_root = release_name
+                if root_dir != os.path.normpath(zzz_dir):
+                    # Staged directories are placed where they would be in the tree
+                    arc_root = os.path.join(release_name, os.path.basename(root_dir))
+                    add_archive_member(tar, hasher, root_dir, arc_root)
+                for entry, is_dir, reason in walk_release_tree(root_dir, keep_lists, remove_lists):
+                    if reason:
+                        continue
+                    arcname = os.path.join(arc_root, os.path.relpath(entry.path, root_dir))
+                    if opts.verbose_bol:
+                        print(arcname)
+                    if tracer.enabled and not is_dir:
+                        tracer.count('files archived')
+                        tracer.count('bytes read', entry.stat(follow_symlinks=False).st_size)
+                    if os.path.normpath(entry.path) == docker_config_path:
+                        # Added from memory with the dns rewrite
+                        data = ''.join(read_docker_config(script_dir)).encode('utf-8')
+                        add_archive_member(tar, hasher, entry.path, arcname, data)
+                    else:
+                        add_archive_member(tar, hasher, entry.path, arcname)
+        tracer.count('bytes written', os.path.getsize(archive_path))
+        if hasher:
+            with tracer.phase('manifest'):
+                write_manifest(archive_path, release_name, output.fileobj, hasher.records(), kept_tarballs(keep_lists, tarball_dir))
+
+    return
+
+
+def planned_size(path, is_dir):
+    # Returns (files, bytes) under a planned removal
+    if not is_dir:
+        return 1, os.lstat(path).st_size
+    files = 0
+    size = 0
+    for root, dirs, file_names in os.walk(path):
+        for file_name in file_names:
+            files += 1
+            size += os.lstat(os.path.join(root, file_name)).st_size
+
+    return files, size
+
+
+def remove_planned(plan_entry):
+    path, is_dir, reason = plan_entry
+    if opts.verbose_bol:
+        print("Removing ", path)
+    if tracer.enabled:
+        # Per reason counters stand for the git cleanup, chipcode prune and tarball filter steps
+        files, size = planned_size(path, is_dir)
+        tracer.count('files deleted', files)
+        tracer.count('bytes freed', size)
+        tracer.count('files deleted (%s)' % reason, files)
+        tracer.count('bytes freed (%s)' % reason, size)
+    if is_dir:
+        rmtree(path)
+    else:
+        os.remove(path)
+
+
+def execute_plan(plan, jobs):
+    # rmtree and unlink are I/O bound, a few threads keep the disk busy
+    with tracer.phase('remove', entries=len(plan)), ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        for result in executor.map(remove_planned, plan):
+            pass
+
+    return
+
+
+def print_manifest(plan):
+    """
+    Prints what the plan removes with file counts and bytes reclaimed
+    """
+    total_files = 0
+    total_bytes = 0
+    print("reason\tfiles\tbytes\tpath")
+    for path, is_dir, reason in plan:
+        files, size = planned_size(path, is_dir)
+        total_files += files
+        total_bytes += size
+        print("%s\t%d\t%d\t%s" % (reason, files, size, path))
+    print("total\t%d\t%d\t%d entries" % (total_files, total_bytes, len(plan)))
+
+    return
+
+
 def remove_files(zzz_dir, chipcode_dir, script_dir, tarball_dir):
     """
     This removes all git and proprietary files
+    Returns {tarball name: [reasons]} of the tarballs kept
     """
-    script_list = ['buildap', 'buildap.py', 'buildap_docker.py', 'helpers.py', 'docker_user_remap', 'docker_config.py']
-    delete_not_in_list(script_dir, script_list)
+    rules = release_rules(zzz_dir, chipcode_dir, script_dir, tarball_dir, opts.package_list_dir)
+    plan = plan_removals(zzz_dir, chipcode_dir, script_dir, tarball_dir, opts.package_list_dir, rules)
 
-    edit_docker_config(script_dir)
+    if opts.dry_run_bol:
+        print_manifest(plan)
+        return kept_tarballs(rules[0], tarball_dir)
 
-    if os.path.exists(os.path.join(zzz_dir, "xxxprop")):
-        if opts.verbose_bol:
-            print("Removing xxxprop")
-        rmtree(os.path.join(zzz_dir, "xxxprop"))
+    execute_plan(plan, opts.jobs)
 
-    if os.path.exists(os.path.join(zzz_dir, "xxxagent")):
-        if opts.verbose_bol:
-            print("Removing xxxagent")
-        rmtree(os.path.join(zzz_dir, "xxxagent"))
+    with tracer.phase('docker config'):
+        edit_docker_config(script_dir)
 
-    delete_git(zzz_dir)
+    return kept_tarballs(rules[0], tarball_dir)
 
-    delete_sensitive_docs(zzz_dir)
 
-    if opts.verbose_bol:
-        print("Removing files from ", chipcode_dir)
+def list_mirror(mirror):
+    # Returns the tarball names in a local directory or rsync mirror
+    if os.path.isdir(mirror):
+        return [file.name for file in os.scandir(mirror) if file.is_file()]
+    output = subprocess.run(['rsync', '--list-only', mirror.rstrip('/') + '/'],
+                            stdout=subprocess.PIPE, check=True, universal_newlines=True).stdout
+    file_names = []
+    for line in output.splitlines():
+        # -rw-r--r--      1,234 2022/01/01 00:00:00 name
+        fields = line.split(None, 4)
+        if len(fields) == 5 and line.startswith('-'):
+            file_names.append(fields[4])
+
+    return file_names
+
+
+def fetch_tarballs(zzz_dir, tarball_dir, mirror):
+    """
+    Copies only the tarballs needed by package-full-list from the mirror
+    """
+    fetch_tarball_pool([(zzz_dir, opts.package_list_dir)], tarball_dir, mirror)
+
+    return
 
-    delete_xxx(zzz_dir, chipcode_dir)
 
+def fetch_tarball_pool(releases, tarball_dir, mirror):
+    """
+    Copies the tarballs needed by any of the (zzz_dir, package_list_dir)
+    releases from the mirror, each tarball once. Tarballs already in
+    tarball_dir are not copied again
+    """
+    file_names = list_mirror(mirror)
+    tarball_index = index_tarball_names(file_names)
+    package_list = set()
+    for zzz_dir, package_list_dir in releases:
+        # Sources the mirror lacks are printed here, before anything is copied
+        if len(releases) > 1:
+            print("Resolving tarballs for ", package_list_dir)
+        package_list.update(resolve_tarballs(zzz_dir, tarball_index, iter_package_list(package_list_dir)))
+    # Only tarballs in the mirror listing are resolved, nothing is dropped here
+    package_list = sorted(package_list)
     if opts.verbose_bol:
-        print("Removing files from ", tarball_dir)
+        print("Fetching %d of %d tarballs from %s" % (len(package_list), len(file_names), mirror))
+    tracer.count('tarballs kept', len(package_list))
+
+    if os.path.isdir(mirror):
+        for file_name in package_list:
+            source = os.path.join(mirror, file_name)
+            destination = os.path.join(tarball_dir, file_name)
+            if os.path.exists(destination):
+                continue
+            if opts.verbose_bol:
+                print("Linking ", file_name)
+            try:
+                # Same filesystem, no data is copied
+                os.link(source, destination)
+            except OSError:
+                shutil.copy2(source, destination)
+        return
 
-    delete_tarballs(zzz_dir, tarball_dir)
+    with tempfile.NamedTemporaryFile('w', suffix='.files-from') as files_from:
+        files_from.write(''.join(file_name + '\n' for file_name in package_list))
+        files_from.flush()
+        args = ['rsync', '-a', '--files-from=%s' % files_from.name, mirror.rstrip('/') + '/', tarball_dir]
+        if opts.verbose_bol:
+            args[1:1] = ['-v', '--progress']
+        subprocess.run(args, check=True)
+
+    return
+
+
+def update_reference(reference_dir, repo_url):
+    """
+    Creates or updates a bare mirror of repo_url used as --reference, so
+    repeated releases only download new objects
+    """
+    with tracer.phase('update reference', reference=reference_dir):
+        if os.path.isdir(reference_dir):
+            if opts.verbose_bol:
+                print("Updating reference ", reference_dir)
+            subprocess.run(['git', '-C', reference_dir, 'fetch', '--prune', '--quiet', 'origin'], check=True)
+        else:
+            if opts.verbose_bol:
+                print("Creating reference ", reference_dir)
+            subprocess.run(['git', 'clone', '--mirror', '--quiet', repo_url, reference_dir], check=True)
+
+    return
+
+
+def clone_args(verbose_git, depth):
+    args = ['git', 'clone']
+    if verbose_git:
+        args.append(verbose_git)
+    if depth:
+        # History is removed from the release, only the tagged tree is needed
+        args += ['--depth', str(depth)]
+
+    return args
+
+
+def submodule_update_args(verbose_git, release_name):
+    # Submodules are fetched without the reference, it only mirrors the main repository
+    args = ['git', '-C', release_name, 'submodule', 'update', '--init', '--recursive', '--jobs', str(opts.jobs)]
+    if verbose_git:
+        args.append(verbose_git)
+    if opts.depth:
+        args += ['--depth', str(opts.depth)]
+    if opts.filter_spec:
+        args += ['--filter', opts.filter_spec]
+
+    return args
+
+
+def refresh_clone(verbose_git, clone_dir, ref, submodules=True):
+    """
+    Checks out the current commit of ref in a clone kept in the pool.
+    A branch or a re-pointed tag may have moved since the clone was made
+    """
+    fetch_args = ['git', '-C', clone_dir, 'fetch', '--force']
+    if verbose_git:
+        fetch_args.append(verbose_git)
+    if opts.depth:
+        fetch_args += ['--depth', str(opts.depth)]
+    fetch_args += ['origin', ref]
+    checkout_args = ['git', '-C', clone_dir, 'checkout', '--force', '--detach', 'FETCH_HEAD']
+    if verbose_git:
+        checkout_args.append(verbose_git)
+    with tracer.phase('refresh', ref=ref, clone=clone_dir):
+        subprocess.run(fetch_args, check=True)
+        subprocess.run(checkout_args, check=True)
+        if submodules:
+            subprocess.run(submodule_update_args(verbose_git, clone_dir), check=True)
+
+    return
+
+
+def clone_source(verbose_git, tag_name, release_name):
+    args = clone_args(verbose_git, opts.depth) + ['-b', tag_name]
+    if opts.filter_spec:
+        args += ['--filter', opts.filter_spec]
+    if opts.reference_dir:
+        args += ['--reference', opts.reference_dir]
+    args += [opts.repo_url, release_name]
+    submodule_args = submodule_update_args(verbose_git, release_name)
+    try:
+        with tracer.phase('clone', tag=tag_name):
+            subprocess.run(args, check=True)
+        with tracer.phase('clone submodules', tag=tag_name):
+            subprocess.run(submodule_args, check=True)
+    except subprocess.CalledProcessError:
+        # Leave nothing behind so the next run can clone again
+        if os.path.isdir(release_name):
+            rmtree(release_name)
+        raise
 
     return
 
@@ -217,22 +1123,287 @@ def remove_files(zzz_dir, chipcode_dir, script_dir, tarball_dir):
 def get_files(verbose_git, release_name, zzz_dir, script_dir, tarball_dir):
     # clone repository if no source directory was specified
     if opts.which_option == 'download':
-        args = "git clone %s -b %s --recursive git@git-xxx.co.jp:xxx/xxx.git %s" % (verbose_git, opts.tag_name, release_name)
-        os.system(args)
+        if opts.reference_dir:
+            update_reference(opts.reference_dir, opts.repo_url)
+        clone_source(verbose_git, opts.tag_name, release_name)
 
     if opts.verbose_bol:
         print("Entering ", zzz_dir)
     os.chdir(zzz_dir)
-    args = "git clone %s git@git-xxx.co.jp:xxx/xxx_scripts.git" % (verbose_git)
-    os.system(args)
+    args = clone_args(verbose_git, opts.depth) + [opts.scripts_url, script_dir]
+    with tracer.phase('clone scripts'):
+        subprocess.run(args, check=True)
 
     if opts.verbose_bol:
         print("Entering ", tarball_dir)
 
     os.mkdir(tarball_dir)
     os.chdir(tarball_dir)
-    args = "rsync -av --progress rsync://xxx.yyy.zzz.co.jp:/tarballs ."
-    os.system(args)
+    with tracer.phase('fetch tarballs', mirror=opts.mirror):
+        if opts.fetch_all_bol:
+            args = "rsync -av --progress %s ." % (opts.mirror)
+            os.system(args)
+        else:
+            # Only transfer the tarballs in package-full-list
+            fetch_tarballs(zzz_dir, tarball_dir, opts.mirror)
+
+    return
+
+
+def download_release_name(model, tag):
+    # Uses tag and model to generate the output tarball's name
+    return "xxx-gpl-release-%s-%s" % (model.replace("/", "-"), tag.replace("/", "-"))
+
+
+def read_batch_file(batch_file):
+    """
+    Returns [(model, tag, package_list_dir)] from a file with one release
+    per line, "<model> <tag> <package-full-list>". Blank lines and lines
+    starting with # are skipped
+    """
+    releases = []
+    with open(batch_file, 'r') as read_file:
+        for line_number, line in enumerate(read_file, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            fields = line.split()
+            if len(fields) != 3:
+                print("%s:%d: expected <model> <tag> <package-full-list>" % (batch_file, line_number))
+                sys.exit(1)
+            releases.append((fields[0], fields[1], os.path.abspath(fields[2])))
+
+    return releases
+
+
+def build_batch(verbose_git):
+    """
+    Builds every release in the batch file from one shared pool: one clone
+    per distinct tag, one scripts clone and one copy of each tarball.
+    Releases are streamed from the pool with their own filters, so no
+    per release tree is assembled and disk use grows with the number of
+    distinct tarballs
+    """
+    releases = read_batch_file(opts.batch_file)
+    pool_dir = os.path.abspath(opts.pool_dir)
+    destination_dir = os.path.abspath(opts.dest_path)
+    script_dir = os.path.join(pool_dir, 'xxx_scripts')
+    tarball_dir = os.path.join(pool_dir, 'tarballs')
+    os.makedirs(tarball_dir, exist_ok=True)
+    source_dirs = {}
+    for model, tag, package_list_dir in releases:
+        source_dirs[tag] = os.path.join(pool_dir, 'src-%s' % tag.replace("/", "-"))
+
+    os.chdir(pool_dir)
+    if opts.reference_dir:
+        update_reference(opts.reference_dir, opts.repo_url)
+    with ThreadPoolExecutor(max_workers=max(1, opts.workers)) as executor:
+        # Clones kept by --keep-pool are brought up to date, branches and tags may have moved
+        clones = []
+        for tag, source_dir in sorted(source_dirs.items()):
+            if os.path.isdir(source_dir):
+                clones.append(executor.submit(refresh_clone, verbose_git, source_dir, tag))
+            else:
+                clones.append(executor.submit(clone_source, verbose_git, tag, source_dir))
+        if os.path.isdir(script_dir):
+            clones.append(executor.submit(refresh_clone, verbose_git, script_dir, 'HEAD', False))
+        else:
+            clones.append(executor.submit(subprocess.run, clone_args(verbose_git, opts.depth) + [opts.scripts_url, script_dir], check=True))
+        for clone in clones:
+            clone.result()
+
+    with tracer.phase('fetch tarballs', mirror=opts.mirror):
+        fetch_tarball_pool([(source_dirs[tag], package_list_dir) for model, tag, package_list_dir in releases],
+                           tarball_dir, opts.mirror)
+
+    # Archives packaged at the same time share the compression threads and memory budget
+    workers = max(1, min(opts.workers, len(releases)))
+    compress_threads = max(1, (opts.compress_threads or os.cpu_count() or 1) // workers)
+    compress_memory = max(1, opts.compress_memory // workers) if opts.compress_memory else 0
+
+    def package_release(release):
+        model, tag, package_list_dir = release
+        release_name = download_release_name(model, tag)
+        zzz_dir = source_dirs[tag]
+        archive_path = os.path.join(destination_dir, release_name + archive_suffix(opts.compress_format))
+        if opts.verbose_bol:
+            print("Packaging ", archive_path)
+        write_release_archive(zzz_dir, os.path.join(zzz_dir, 'xxx/chipcode'), script_dir, tarball_dir,
+                              package_list_dir, release_name, archive_path, compress_threads, compress_memory)
+        return archive_path
+
+    with ThreadPoolExecutor(max_workers=max(1, opts.workers)) as executor:
+        for archive_path in executor.map(package_release, releases):
+            print(archive_path)
+
+    if not opts.keep_pool_bol:
+        rmtree(pool_dir)
+
+    return
+
+
+def archive_suffix(compress_format):
+    if compress_format == 'zstd':
+        return '.tar.zst'
+    return '.tar.xz'
+
+
+def compress_settings(compress_format, level, threads, memory):
+    """
+    Returns (level, threads) with the defaults filled in and the thread
+    count lowered so the compressors fit in memory MiB
+    """
+    if level is None:
+        level = 3 if compress_format == 'zstd' else 6
+    if not threads:
+        threads = os.cpu_count() or 1
+    if compress_format == 'xz' and memory:
+        # Compressor state and two blocks per thread
+        thread_memory = xz_level_memory[level] + 2 * 3 * xz_level_dict_size[level]
+        threads = max(1, min(threads, int(memory // thread_memory)))
+
+    return level, threads
+
+
+def open_compressed(archive_path, compress_format, level, threads, memory):
+    # The writer's fileobj hashes the archive as it is written
+    level, threads = compress_settings(compress_format, level, threads, memory)
+    if compress_format == 'zstd':
+        return ZstdWriter(DigestFile(open(archive_path, 'wb')), level, threads)
+    return ParallelXzWriter(DigestFile(open(archive_path, 'wb')), level, threads)
+
+
+def compress_tree(home_dir, release_name, archive_path, tarballs):
+    """
+    tar writes the archive to a pipe and it is compressed on all threads
+    For the manifest the same stream is read back as it passes through
+    and the members are hashed, nothing is read twice
+    """
+    args = ['tar', '-cf', '-', release_name]
+    if opts.verbose_bol:
+        args.insert(1, '-v')
+    with MemberHasher(opts.jobs) if opts.manifest_bol else nullcontext() as hasher:
+        with tracer.phase('archive', archive=archive_path, stream=False):
+            process = subprocess.Popen(args, cwd=home_dir or None, stdout=subprocess.PIPE)
+            with open_compressed(archive_path, opts.compress_format, opts.compress_level,
+                                 opts.compress_threads, opts.compress_memory) as output:
+                if hasher:
+                    tee = TeeReader(process.stdout, output)
+                    with tarfile.open(fileobj=tee, mode='r|') as tar:
+                        hash_archive_members(tar, hasher)
+                    # Record padding after the end of the archive
+                    tee.drain()
+                else:
+                    for block in iter(lambda: process.stdout.read(archive_block_size), b''):
+                        output.write(block)
+                        tracer.count('bytes read', len(block))
+            if process.wait() != 0:
+                raise IOError("tar exited with %d" % process.returncode)
+        tracer.count('bytes written', os.path.getsize(archive_path))
+        if hasher:
+            with tracer.phase('manifest'):
+                write_manifest(archive_path, release_name, output.fileobj, hasher.records(), tarballs)
+
+    return
+
+
+def make_benchmark_tree(tree_dir, size_mb):
+    """
+    Writes a reproducible tree of source like text and incompressible
+    blobs, about size_mb MiB in total
+    """
+    rand = random.Random(0)
+    words = ['static', 'int', 'return', 'struct', 'const', 'char', 'void', 'if', 'else', 'for',
+             'PKG_NAME', 'PKG_VERSION', 'include', 'define', 'license', 'GPL', 'buffer', 'size']
+    written = 0
+    index = 0
+    while written < size_mb * 1024 * 1024:
+        file_dir = os.path.join(tree_dir, 'pkg%03d' % (index // 20))
+        os.makedirs(file_dir, exist_ok=True)
+        if index % 10 == 9:
+            # Already compressed sources and images
+            data = rand.getrandbits(256 * 1024 * 8).to_bytes(256 * 1024, 'little')
+            file_name = 'blob%d.bin' % index
+        else:
+            lines = [' '.join(rand.choice(words) for i in range(rand.randint(3, 12))) for j in range(4000)]
+            data = ('\n'.join(lines) + '\n').encode('utf-8')
+            file_name = 'file%d.c' % index
+        with open(os.path.join(file_dir, file_name), 'wb') as write_file:
+            write_file.write(data)
+        written += len(data)
+        index += 1
+
+    return
+
+
+def compress_benchmark():
+    """
+    Compresses the same tree with each thread count and prints wall time and size
+    """
+    work_dir = tempfile.mkdtemp(prefix='compress-benchmark-')
+    try:
+        if opts.src_path:
+            tree_dir = opts.src_path
+        else:
+            tree_dir = os.path.join(work_dir, 'tree')
+            make_benchmark_tree(tree_dir, opts.size_mb)
+        print("format\tlevel\tthreads\tseconds\tbytes")
+        for threads in [int(t) for t in opts.threads_list.split(',')]:
+            archive_path = os.path.join(work_dir, 'out' + archive_suffix(opts.compress_format))
+            level, threads = compress_settings(opts.compress_format, opts.compress_level, threads, opts.compress_memory)
+            start = time.time()
+            with open_compressed(archive_path, opts.compress_format, level, threads, 0) as output:
+                with tarfile.open(fileobj=output, mode='w|') as tar:
+                    tar.add(tree_dir, arcname='tree')
+            seconds = time.time() - start
+            print("%s\t%d\t%d\t%.2f\t%d" % (opts.compress_format, level, threads, seconds, os.path.getsize(archive_path)))
+    finally:
+        rmtree(work_dir)
+
+    return
+
+
+def add_package_list_arguments(sub_parser):
+    sub_parser.add_argument('--allow-malformed',
+                            action='store_true',
+                            default=False,
+                            dest='allow_malformed_bol',
+                            help='skip malformed package-full-list entries and release without their tarballs instead of failing')
+
+
+def add_manifest_arguments(sub_parser):
+    sub_parser.add_argument('--no-manifest',
+                            action='store_false',
+                            default=True,
+                            dest='manifest_bol',
+                            help='do not write <archive>.manifest.json with the SHA-256 of every member and the tarballs kept')
+
+
+def add_compress_arguments(sub_parser):
+    sub_parser.add_argument('--compress-format',
+                            action='store',
+                            choices=['xz', 'zstd'],
+                            default='xz',
+                            dest='compress_format',
+                            help='format of the output archive, xz or zstd (default: xz)')
+    sub_parser.add_argument('--compress-level',
+                            action='store',
+                            type=int,
+                            default=None,
+                            dest='compress_level',
+                            help='compression level (default: 6 for xz, 3 for zstd)')
+    sub_parser.add_argument('--compress-threads',
+                            action='store',
+                            type=int,
+                            default=0,
+                            dest='compress_threads',
+                            help='number of compression threads (default: all cores)')
+    sub_parser.add_argument('--compress-memory',
+                            action='store',
+                            type=int,
+                            default=2048,
+                            dest='compress_memory',
+                            help='memory budget in MiB for xz compression, fewer threads are used to stay under it (default: 2048)')
 
     return
 
@@ -265,10 +1436,70 @@ def parse_program_arguments():
                                  dest='dest_path',
                                  default=".",
                                  help='dest is used to specify the full path to the final destination of the output tarball, do not use hanging forward slashes')
+    download_parser.add_argument('--repo-url',
+                                 action='store',
+                                 dest='repo_url',
+                                 default=default_repo_url,
+                                 help='url of the xxx repository, use file:// urls for local repositories so --depth applies')
+    download_parser.add_argument('--depth',
+                                 action='store',
+                                 type=int,
+                                 dest='depth',
+                                 default=1,
+                                 help='history depth of the clones, 0 clones the full history (default: 1)')
+    download_parser.add_argument('--filter',
+                                 action='store',
+                                 dest='filter_spec',
+                                 default='',
+                                 help='partial clone filter passed to git clone, for example blob:none')
+    download_parser.add_argument('--reference',
+                                 action='store',
+                                 dest='reference_dir',
+                                 default='',
+                                 help='local bare mirror of the xxx repository, created or updated then used as git clone --reference')
+    download_parser.add_argument('--scripts-url',
+                                 action='store',
+                                 dest='scripts_url',
+                                 default=default_scripts_url,
+                                 help='url of the xxx_scripts repository')
+    download_parser.add_argument('--mirror',
+                                 action='store',
+                                 dest='mirror',
+                                 default=default_mirror,
+                                 help='rsync url or local directory of the tarball mirror')
+    download_parser.add_argument('--fetch-all',
+                                 action='store_true',
+                                 default=False,
+                                 dest='fetch_all_bol',
+                                 help='transfer the whole tarball mirror instead of only the tarballs in the package list')
+    download_parser.add_argument('--jobs', '-j',
+                                 action='store',
+                                 type=int,
+                                 default=4,
+                                 dest='jobs',
+                                 help='number of threads used to remove files and submodules fetched at the same time')
+    download_parser.add_argument('--dry-run',
+                                 action='store_true',
+                                 default=False,
+                                 dest='dry_run_bol',
+                                 help='print what would be removed with file counts and bytes, nothing is removed or archived')
+    download_parser.add_argument('--stream',
+                                 action='store_true',
+                                 default=False,
+                                 dest='stream_bol',
+                                 help='write the release archive straight from the source tree, nothing in the source tree is changed or removed')
+    download_parser.add_argument('--trace',
+                                 action='store',
+                                 dest='trace_file',
+                                 default='',
+                                 help='write phase timings and I/O counters to this file in Chrome trace-event JSON format')
     download_parser.add_argument('package_list_dir',
                                  action='store',
                                  type=str,
                                  help='full path to the list "package-full-list" in the output directory of the xxx repository, that list is used to filter tarballs')
+    add_compress_arguments(download_parser)
+    add_package_list_arguments(download_parser)
+    add_manifest_arguments(download_parser)
     download_parser.set_defaults(which_option='download')
 
     local_parser = subparsers.add_parser('local', help="")
@@ -288,18 +1519,187 @@ def parse_program_arguments():
                               dest='dest_path',
                               default=".",
                               help='dest is used to specify the full path to the final destination of the output tarball, do not use hanging forward slashes')
+    local_parser.add_argument('--depth',
+                              action='store',
+                              type=int,
+                              dest='depth',
+                              default=1,
+                              help='history depth of the xxx_scripts clone, 0 clones the full history (default: 1)')
+    local_parser.add_argument('--scripts-url',
+                              action='store',
+                              dest='scripts_url',
+                              default=default_scripts_url,
+                              help='url of the xxx_scripts repository')
+    local_parser.add_argument('--mirror',
+                              action='store',
+                              dest='mirror',
+                              default=default_mirror,
+                              help='rsync url or local directory of the tarball mirror')
+    local_parser.add_argument('--fetch-all',
+                              action='store_true',
+                              default=False,
+                              dest='fetch_all_bol',
+                              help='transfer the whole tarball mirror instead of only the tarballs in the package list')
+    local_parser.add_argument('--jobs', '-j',
+                              action='store',
+                              type=int,
+                              default=4,
+                              dest='jobs',
+                              help='number of threads used to remove files and submodules fetched at the same time')
+    local_parser.add_argument('--dry-run',
+                              action='store_true',
+                              default=False,
+                              dest='dry_run_bol',
+                              help='print what would be removed with file counts and bytes, nothing is removed or archived')
+    local_parser.add_argument('--stream',
+                              action='store_true',
+                              default=False,
+                              dest='stream_bol',
+                              help='write the release archive straight from the source tree, nothing in the source tree is changed or removed')
+    local_parser.add_argument('--trace',
+                              action='store',
+                              dest='trace_file',
+                              default='',
+                              help='write phase timings and I/O counters to this file in Chrome trace-event JSON format')
     local_parser.add_argument('package_list_dir',
                               action='store',
                               type=str,
                               help='full path to the list "package-full-list" in the output directory of the xxx repository, that list is used to filter tarballs')
+    add_compress_arguments(local_parser)
+    add_package_list_arguments(local_parser)
+    add_manifest_arguments(local_parser)
     local_parser.set_defaults(which_option='local')
 
+    batch_parser = subparsers.add_parser('batch', help="build the releases listed in a batch file from one shared pool of clones and tarballs")
+    batch_parser.add_argument('--verbose', '-v',
+                              action='store_true',
+                              default=False,
+                              dest='verbose_bol',
+                              help='verbose will print out the codes movement to the terminal')
+    batch_parser.add_argument('--dest', '-d',
+                              action='store',
+                              dest='dest_path',
+                              default=".",
+                              help='dest is used to specify the full path to the final destination of the output tarballs')
+    batch_parser.add_argument('--pool',
+                              action='store',
+                              dest='pool_dir',
+                              default='gpl-release-pool',
+                              help='directory holding the shared clones and tarballs (default: gpl-release-pool)')
+    batch_parser.add_argument('--keep-pool',
+                              action='store_true',
+                              default=False,
+                              dest='keep_pool_bol',
+                              help='keep the pool after the batch so later batches reuse its tarballs and fetch into its clones')
+    batch_parser.add_argument('--workers', '-w',
+                              action='store',
+                              type=int,
+                              dest='workers',
+                              default=2,
+                              help="""number of releases cloned or packaged at the same time, the compression threads
+                                      and memory budget are divided between them (default: 2)""")
+    batch_parser.add_argument('--jobs', '-j',
+                              action='store',
+                              type=int,
+                              default=4,
+                              dest='jobs',
+                              help='number of submodules fetched at the same time')
+    batch_parser.add_argument('--repo-url',
+                              action='store',
+                              dest='repo_url',
+                              default=default_repo_url,
+                              help='url of the xxx repository, use file:// urls for local repositories so --depth applies')
+    batch_parser.add_argument('--depth',
+                              action='store',
+                              type=int,
+                              dest='depth',
+                              default=1,
+                              help='history depth of the clones, 0 clones the full history (default: 1)')
+    batch_parser.add_argument('--filter',
+                              action='store',
+                              dest='filter_spec',
+                              default='',
+                              help='partial clone filter passed to git clone, for example blob:none')
+    batch_parser.add_argument('--reference',
+                              action='store',
+                              dest='reference_dir',
+                              default='',
+                              help='local bare mirror of the xxx repository, created or updated then used as git clone --reference')
+    batch_parser.add_argument('--scripts-url',
+                              action='store',
+                              dest='scripts_url',
+                              default=default_scripts_url,
+                              help='url of the xxx_scripts repository')
+    batch_parser.add_argument('--mirror',
+                              action='store',
+                              dest='mirror',
+                              default=default_mirror,
+                              help='rsync url or local directory of the tarball mirror')
+    batch_parser.add_argument('--trace',
+                              action='store',
+                              dest='trace_file',
+                              default='',
+                              help='write phase timings and I/O counters to this file in Chrome trace-event JSON format')
+    batch_parser.add_argument('batch_file',
+                              action='store',
+                              type=str,
+                              help='file with one release per line: <model> <tag> <full path to package-full-list>')
+    add_compress_arguments(batch_parser)
+    add_package_list_arguments(batch_parser)
+    add_manifest_arguments(batch_parser)
+    batch_parser.set_defaults(which_option='batch')
+
+    benchmark_parser = subparsers.add_parser('compress-benchmark', help="compare compression wall time and size across thread counts")
+    benchmark_parser.add_argument('--src', '-s',
+                                  action='store',
+                                  dest='src_path',
+                                  default='',
+                                  help='directory to compress, a synthetic tree is generated when not given')
+    benchmark_parser.add_argument('--size',
+                                  action='store',
+                                  type=int,
+                                  dest='size_mb',
+                                  default=64,
+                                  help='size in MiB of the synthetic tree (default: 64)')
+    benchmark_parser.add_argument('--threads-list',
+                                  action='store',
+                                  dest='threads_list',
+                                  default='1,2,4,8',
+                                  help='comma separated thread counts to compare (default: 1,2,4,8)')
+    add_compress_arguments(benchmark_parser)
+    benchmark_parser.set_defaults(which_option='compress-benchmark', verbose_bol=False, trace_file='')
+
+    verify_parser = subparsers.add_parser('verify', help="check a release archive against its manifest without extracting it")
+    verify_parser.add_argument('--manifest',
+                               action='store',
+                               dest='manifest_file',
+                               default='',
+                               help='manifest to check against (default: <archive>.manifest.json)')
+    verify_parser.add_argument('--jobs', '-j',
+                               action='store',
+                               type=int,
+                               default=4,
+                               dest='jobs',
+                               help='number of threads hashing members')
+    verify_parser.add_argument('archive_path',
+                               action='store',
+                               type=str,
+                               help='release archive to check')
+    verify_parser.set_defaults(which_option='verify', verbose_bol=False, trace_file='')
+
     # This displays help message and exits the script if no option or arguments are passed
     if len(sys.argv) == 1:
         parser.print_help(sys.stderr)
         sys.exit(1)
 
-    return parser.parse_known_args()
+    opts, extra = parser.parse_known_args()
+    # verify has no compression options
+    level_range = compress_level_range.get(getattr(opts, 'compress_format', None))
+    if level_range and opts.compress_level is not None and \
+            not level_range[0] <= opts.compress_level <= level_range[1]:
+        parser.error('--compress-level for %s must be from %d to %d' % (opts.compress_format, level_range[0], level_range[1]))
+
+    return opts, extra
 
 
 ###### Main ######
@@ -307,12 +1707,32 @@ if __name__ == "__main__":
 
     opts, extra = parse_program_arguments()
 
+    if opts.trace_file:
+        tracer = Tracer()
+        # Written on every exit so failed and interrupted releases are traced too
+        atexit.register(tracer.write, os.path.abspath(opts.trace_file))
+
+    if opts.which_option == 'compress-benchmark':
+        compress_benchmark()
+        sys.exit(0)
+
+    if opts.which_option == 'verify':
+        problems = verify_archive(opts.archive_path, opts.manifest_file or manifest_path(opts.archive_path))
+        for problem in problems:
+            print(problem)
+        if problems:
+            sys.exit(1)
+        print("%s matches its manifest" % opts.archive_path)
+        sys.exit(0)
+
     if opts.verbose_bol:
         verbose_git = ""
-        verbose_tar = "-v"
     else:
         verbose_git = "--quiet"
-        verbose_tar = ""
+
+    if opts.which_option == 'batch':
+        build_batch(verbose_git)
+        sys.exit(0)
 
     if opts.verbose_bol:
         if opts.which_option == 'download':
@@ -325,10 +1745,7 @@ if __name__ == "__main__":
         # Uses the source directory name to generate the output tarball's name
         release_name = opts.src_path.split('/').pop()
     elif opts.which_option == 'download':
-        # Uses tag and model to generate the output tarball's name
-        tag = opts.tag_name.replace("/", "-")
-        model = opts.target_model.replace("/", "-")
-        release_name = "xxx-gpl-release-%s-%s" % (model, tag)
+        release_name = download_release_name(opts.target_model, opts.tag_name)
 
     # destination_dir determines where the output tarball will go
     # The destination directory is set to '.' by default.
@@ -345,19 +1762,38 @@ if __name__ == "__main__":
         home_dir = os.getcwd()
         zzz_dir = os.path.join(home_dir, release_name)
     chipcode_dir = os.path.join(zzz_dir, 'xxx/chipcode')
-    script_dir = os.path.join(zzz_dir, 'xxx_scripts')
-    tarball_dir = os.path.join(zzz_dir, 'tarballs')
-
-    # Download files that are needed
-    get_files(verbose_git, release_name, zzz_dir, script_dir, tarball_dir)
+    if opts.stream_bol:
+        # Scripts and tarballs are staged outside of the source tree
+        staging_dir = tempfile.mkdtemp(prefix='%s-' % release_name, dir=home_dir)
+        script_dir = os.path.join(staging_dir, 'xxx_scripts')
+        tarball_dir = os.path.join(staging_dir, 'tarballs')
+    else:
+        script_dir = os.path.join(zzz_dir, 'xxx_scripts')
+        tarball_dir = os.path.join(zzz_dir, 'tarballs')
 
-    # Remove files that are not to be publicaly released
-    remove_files(zzz_dir, chipcode_dir, script_dir, tarball_dir)
+    # The staging directory can hold GBs of tarballs, it is removed on failures too
+    try:
+        # Download files that are needed
+        get_files(verbose_git, release_name, zzz_dir, script_dir, tarball_dir)
 
-    # Move to one directory up to tar the xxx repository
-    os.chdir(home_dir)
-    args = "tar %s -cJf %s/%s.tar.xz %s" % (verbose_tar, destination_dir, release_name, release_name)
-    os.system(args)
+        if opts.stream_bol:
+            if opts.dry_run_bol:
+                print_manifest(plan_removals(zzz_dir, chipcode_dir, script_dir, tarball_dir, opts.package_list_dir))
+            else:
+                archive_path = os.path.join(home_dir, destination_dir, release_name + archive_suffix(opts.compress_format))
+                write_release_archive(zzz_dir, chipcode_dir, script_dir, tarball_dir, opts.package_list_dir, release_name, archive_path)
+        else:
+            # Remove files that are not to be publicaly released
+            tarballs = remove_files(zzz_dir, chipcode_dir, script_dir, tarball_dir)
+
+            # Move to one directory up to tar the xxx repository
+            os.chdir(home_dir)
+            if not opts.dry_run_bol:
+                archive_path = os.path.join(home_dir, destination_dir, release_name + archive_suffix(opts.compress_format))
+                compress_tree(home_dir, release_name, archive_path, tarballs)
+    finally:
+        if opts.stream_bol:
+            rmtree(staging_dir)
 
     # If source directory is provided, do not remove it after tarball is created.
     # The source directory may be used for other purposes.
@@ -1,10 +1,32 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 # Copyright (C) 2022 Ben Pepe
 import os
 import sys
 import glob
 import argparse
 import re
+import json
+import hashlib
+import fnmatch
+import tarfile
+import zipfile
+import threading
+import time
+import atexit
+import io
+import struct
+import signal
+import socket
+import socketserver
+import ctypes
+import ctypes.util
+import mmap
+import zlib
+import xml.etree.ElementTree as ElementTree
+from bisect import bisect_left
+from contextlib import contextmanager, nullcontext, redirect_stdout
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 # This script will check for gpl infractions and license information in a package's Makefile
 # During the build process a script generates a license page for each installed non proprietary package.
@@ -39,16 +61,491 @@ import re
 # -------------------------------------------------------------------------------
 
 
+# Bump when parse_makefile changes what it stores so old cached results are not used
+RESULT_CACHE_VERSION = 3
+# metadata keys filled in by parse_makefile, these are what the result cache keeps
+MAKEFILE_METADATA_KEYS = ['root_makefile', 'proprietary', 'license_types', 'license_file_names', 'contains_gpl',
+                          'source_file', 'source_prefix']
+# Source archive types that can be checked for license files
+SOURCE_ARCHIVE_SUFFIXES = ['.tar.gz', '.tgz', '.tar.xz', '.txz', '.tar.bz2', '.tbz2', '.zip']
+# Directories inside a package that hold sources or install files, never package Makefiles
+VENDORED_DIRS = ['src', 'files', 'patches', '.git', '.svn', 'build_dir', 'staging_dir']
+# Make variable assignment: NAME := value, also =, ::=, += and ?=
+MAKEFILE_ASSIGN_RE = re.compile(r'^\s*(?:override\s+)?(?:export\s+)?([A-Za-z0-9_./-]+)\s*(::=|:=|\+=|\?=|=)\s*(.*?)\s*$')
+# $(NAME) or ${NAME} reference
+MAKEFILE_VAR_RE = re.compile(r'\$[({]([A-Za-z0-9_./-]+)[)}]')
+# Trailing comment that is not escaped
+MAKEFILE_COMMENT_RE = re.compile(r'(?<!\\)#.*$')
+# inotify flags from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+MAKEFILE_WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE |
+                       IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+# struct inotify_event header: wd, mask, cookie, len
+INOTIFY_EVENT = struct.Struct('iIII')
+# Words joined into one license text fingerprint
+LICENSE_NGRAM = 5
+# Share of a reference license's fingerprints a file must contain to be classified as that license
+LICENSE_MATCH_THRESHOLD = 0.5
+# License files larger than this are not classified
+LICENSE_FILE_MAX_SIZE = 1024 * 1024
+# Only fingerprints with these bits clear are kept, the same sample is taken from every text
+LICENSE_SAMPLE_MASK = 3
+LICENSE_WORD_RE = re.compile(rb'[a-z0-9]+')
+# Copyright lines differ between copies of the same license
+LICENSE_COPYRIGHT_RE = re.compile(r'^.*copyright.*$', re.MULTILINE)
+LICENSE_INDEX_MAGIC = b'CHKLICX1'
+# status of a PackageResult, proprietary packages pass
+PACKAGE_STATUSES = ['PASS', 'FAILED', 'NOT_FOUND']
+# metadata keys a PackageResult reports besides the package name
+RESULT_METADATA_KEYS = ['package_root_dir'] + MAKEFILE_METADATA_KEYS
+OUTPUT_FORMATS = ['text', 'json', 'junit']
+# Last line of a server response, followed by the exit status and 1 if the check stopped early
+SERVER_STATUS_MARK = '\0'
+
+
+class Tracer(object):
+    """
+    Records phases with their wall and cpu time, and counters, and writes
+    them as a Chrome trace-event file. The file is plain JSON, counters
+    are also kept under otherData
+    """
+    enabled = True
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.events = []
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name, **args):
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        thread_cpu = time.thread_time()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            # cpu_ms includes every thread of the process, thread_cpu_ms only the one running the phase
+            args['cpu_ms'] = (time.process_time() - cpu) * 1000
+            args['thread_cpu_ms'] = (time.thread_time() - thread_cpu) * 1000
+            event = {'name': name, 'ph': 'X', 'pid': os.getpid(), 'tid': threading.get_ident(),
+                     'ts': (wall - self.start) * 1000000, 'dur': (end - wall) * 1000000, 'args': args}
+            with self.lock:
+                self.events.append(event)
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def write(self, trace_file):
+        end = (time.perf_counter() - self.start) * 1000000
+        events = list(self.events)
+        for name, value in sorted(self.counters.items()):
+            events.append({'name': name, 'ph': 'C', 'pid': os.getpid(), 'ts': end, 'args': {name: value}})
+        trace = {'traceEvents': events, 'displayTimeUnit': 'ms',
+                 'otherData': {'command': ' '.join(sys.argv), 'wall_s': end / 1000000,
+                               'cpu_s': time.process_time(), 'counters': self.counters}}
+        with open(trace_file, 'w') as write_file:
+            json.dump(trace, write_file, indent=1)
+
+
+class NullTracer(object):
+    """
+    Used when tracing is off, phases and counters cost one call
+    """
+    enabled = False
+
+    def phase(self, name, **args):
+        return nullcontext()
+
+    def count(self, name, value=1):
+        pass
+
+
+class MakefileWatcher(object):
+    """
+    Watches the directories of checked packages with inotify. A package is
+    trusted by the server until one of its Makefiles or sub directories
+    changes, then its cached result is validated again
+    """
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        # {wd: set of package dirs}, {dir_path: wd}
+        self.wd_packages = {}
+        self.dir_wds = {}
+        self.packages = set()
+        self.lock = threading.Lock()
+
+    def watch(self, package_root_dir, dir_paths):
+        with self.lock:
+            for dir_path in dir_paths:
+                wd = self.dir_wds.get(dir_path)
+                if wd is None:
+                    wd = self.libc.inotify_add_watch(self.fd, os.fsencode(dir_path), MAKEFILE_WATCH_MASK)
+                    if wd < 0:
+                        # Out of watches, the package is validated with stat on every check
+                        return
+                    self.dir_wds[dir_path] = wd
+                self.wd_packages.setdefault(wd, set()).add(package_root_dir)
+            self.packages.add(package_root_dir)
+
+    def watching(self, package_root_dir):
+        with self.lock:
+            return package_root_dir in self.packages
+
+    def read_changes(self):
+        # Drops the packages whose directories had events since the last call
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return
+            with self.lock:
+                offset = 0
+                while offset < len(data):
+                    wd, mask, cookie, length = INOTIFY_EVENT.unpack_from(data, offset)
+                    name = data[offset + INOTIFY_EVENT.size:offset + INOTIFY_EVENT.size + length].rstrip(b'\0')
+                    offset += INOTIFY_EVENT.size + length
+                    if mask & IN_Q_OVERFLOW:
+                        # Events were lost, nothing can be trusted
+                        self.packages.clear()
+                        continue
+                    if name != b'Makefile' and not mask & (IN_ISDIR | IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED):
+                        continue
+                    self.packages.difference_update(self.wd_packages.get(wd, ()))
+                    if mask & IN_IGNORED:
+                        # The directory is gone, so is its watch
+                        self.wd_packages.pop(wd, None)
+                        self.dir_wds = dict((dir_path, dir_wd) for dir_path, dir_wd in self.dir_wds.items() if dir_wd != wd)
+
+
+def license_fingerprints(text):
+    """
+    Returns a sample of the hashes of the lower case word n-grams in text,
+    punctuation, white space and copyright lines are ignored
+    """
+    if 'License-Text:' in text:
+        # Linux kernel LICENSES files describe their usage before the text
+        text = text.split('License-Text:', 1)[1]
+    text = LICENSE_COPYRIGHT_RE.sub('', text.lower())
+    words = [zlib.crc32(word) for word in LICENSE_WORD_RE.findall(text.encode('utf-8'))]
+    # Tuples of ints hash the same in every process
+    ngrams = zip(*[words[i:] for i in range(LICENSE_NGRAM)])
+    return set(fingerprint for fingerprint in (hash(ngram) & 0xffffffff for ngram in ngrams)
+               if not fingerprint & LICENSE_SAMPLE_MASK)
+
+
+def license_base(license_type):
+    # GPL-2.0+, GPL-2.0-only and GPL-2.0-or-later share one license text
+    license_type = license_type.lower().rstrip('+')
+    for suffix in ['-only', '-or-later']:
+        if license_type.endswith(suffix):
+            license_type = license_type[:-len(suffix)]
+    return license_type
+
+
+class LicenseIndex(object):
+    """
+    Fingerprints of reference license texts in a file that is memory
+    mapped, so the index is built once and loading it reads nothing but
+    its header. The file holds a JSON header followed by the sorted
+    fingerprints and the license each one belongs to
+    """
+    def __init__(self, index_file):
+        with open(index_file, 'rb') as read_file:
+            self.map = mmap.mmap(read_file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[:len(LICENSE_INDEX_MAGIC)] != LICENSE_INDEX_MAGIC:
+            raise ValueError('{0} is not a license index'.format(index_file))
+        offset = len(LICENSE_INDEX_MAGIC)
+        header_size = struct.unpack_from('I', self.map, offset)[0]
+        offset += 4
+        self.header = json.loads(self.map[offset:offset + header_size].decode('utf-8'))
+        offset += header_size
+        offset += -offset % 4
+        count = self.header['count']
+        view = memoryview(self.map)
+        self.fingerprints = view[offset:offset + count * 4].cast('I')
+        self.license_ids = view[offset + count * 4:offset + count * 6].cast('H')
+        self.licenses = [license['id'] for license in self.header['licenses']]
+        self.sizes = [license['fingerprints'] for license in self.header['licenses']]
+        self.bases = set(license_base(license_id) for license_id in self.licenses)
+
+    @staticmethod
+    def text_stamps(texts_dir):
+        stamps = {}
+        for entry in os.scandir(texts_dir):
+            if entry.is_file():
+                stat = entry.stat()
+                stamps[entry.name] = [stat.st_mtime_ns, stat.st_size]
+        return stamps
+
+    @staticmethod
+    def build(texts_dir, index_file):
+        """
+        Writes the index of every license text in texts_dir, files are
+        named by SPDX id with an optional .txt suffix
+        """
+        licenses = []
+        pairs = []
+        stamps = LicenseIndex.text_stamps(texts_dir)
+        for file_name in sorted(stamps):
+            with open(os.path.join(texts_dir, file_name), 'r', errors='replace') as read_file:
+                fingerprints = license_fingerprints(read_file.read())
+            if not fingerprints:
+                continue
+            license_number = len(licenses)
+            licenses.append({'id': file_name[:-4] if file_name.endswith('.txt') else file_name,
+                             'fingerprints': len(fingerprints)})
+            pairs += [(fingerprint, license_number) for fingerprint in fingerprints]
+        pairs.sort()
+        header = json.dumps({'texts_dir': texts_dir, 'stamps': stamps, 'ngram': LICENSE_NGRAM,
+                             'python': list(sys.version_info[:2]),
+                             'count': len(pairs), 'licenses': licenses}).encode('utf-8')
+        data = bytearray(LICENSE_INDEX_MAGIC)
+        data += struct.pack('I', len(header))
+        data += header
+        data += b'\0' * (-len(data) % 4)
+        data += struct.pack('{0}I'.format(len(pairs)), *[fingerprint for fingerprint, license_number in pairs])
+        data += struct.pack('{0}H'.format(len(pairs)), *[license_number for fingerprint, license_number in pairs])
+        os.makedirs(os.path.dirname(index_file), exist_ok=True)
+        tmp_file = '{0}.{1}'.format(index_file, os.getpid())
+        with open(tmp_file, 'wb') as write_file:
+            write_file.write(data)
+        os.replace(tmp_file, index_file)
+
+    @staticmethod
+    def load(texts_dir, index_file):
+        # Rebuilt when a license text was added, removed or changed
+        try:
+            index = LicenseIndex(index_file)
+            if (index.header['texts_dir'] == texts_dir and index.header['ngram'] == LICENSE_NGRAM and
+                    index.header['python'] == list(sys.version_info[:2]) and
+                    index.header['stamps'] == LicenseIndex.text_stamps(texts_dir)):
+                return index
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+        LicenseIndex.build(texts_dir, index_file)
+        return LicenseIndex(index_file)
+
+    def stamp(self):
+        # Identifies this index in cached classifications
+        return hashlib.sha1(json.dumps([self.header['stamps'], self.header['python']], sort_keys=True).encode('utf-8')).hexdigest()
+
+    def knows(self, license_type):
+        return license_base(license_type) in self.bases
+
+    def classify(self, text):
+        """
+        Returns (license id, score) of the reference license whose text is
+        most contained in text, license id is None below the threshold
+        """
+        counts = [0] * len(self.licenses)
+        fingerprints = self.fingerprints
+        license_ids = self.license_ids
+        count = len(fingerprints)
+        for fingerprint in license_fingerprints(text):
+            i = bisect_left(fingerprints, fingerprint)
+            while i < count and fingerprints[i] == fingerprint:
+                counts[license_ids[i]] += 1
+                i += 1
+        best = None
+        best_key = (0, 0)
+        for license_number, matched in enumerate(counts):
+            # Ties such as BSD-2-Clause in a BSD-3-Clause file go to the larger text
+            key = (round(matched / self.sizes[license_number], 2), matched)
+            if key > best_key:
+                best, best_key = license_number, key
+        if best is None or best_key[0] < LICENSE_MATCH_THRESHOLD:
+            return None, best_key[0]
+        return self.licenses[best], best_key[0]
+
+
+class PackageNotFoundError(LookupError):
+    pass
+
+
+class PackageResult(object):
+    """
+    Outcome of checking one package
+    status is one of PACKAGE_STATUSES, reasons lists why the package failed,
+    metadata is what was read from the package Makefiles and lines is the
+    text the command line prints for the package
+    """
+    def __init__(self, package_name, status, reasons, metadata, lines):
+        self.package_name = package_name
+        self.status = status
+        self.reasons = reasons
+        self.metadata = metadata
+        self.lines = lines
+
+    @property
+    def passed(self):
+        return self.status == 'PASS'
+
+    def to_dict(self):
+        metadata = dict((key, self.metadata[key]) for key in RESULT_METADATA_KEYS if key in self.metadata)
+        return {'package_name': self.package_name, 'status': self.status,
+                'reasons': self.reasons, 'metadata': metadata}
+
+
 class CheckLicense(object):
-    def __init__(self, verbose):
-        self.current_dir = os.getcwd()
+    def __init__(self, verbose, index_file=None, cache_file=None, dl_dir=None, tracer=None, license_index=None,
+                 start_dir=None):
+        # Packages are searched for under start_dir, the current directory by default
+        self.current_dir = os.path.abspath(start_dir) if start_dir else os.getcwd()
         self.pkg_list = []
         self.verbose_bol = verbose
         self.exclude_list = ['feeds', 'build_dir', 'staging_dir', 'tmp', 'buildap', 'script', 'docker']
+        # Package index per search root, {start_dir: {dir_name: first_path}}
+        self.package_index = {}
+        # File used to keep the package index between runs, None disables it
+        self.index_file = index_file
+        self.index_lock = threading.Lock()
+        # Per thread output buffer so parallel checks print in input order
+        self.output = threading.local()
+        # File used to keep parse_makefile results between runs, None disables it
+        self.cache_file = cache_file
+        self.result_cache = None
+        self.cache_dirty = False
+        self.cache_lock = threading.Lock()
+        self.cache_stats = {'hits': 0, 'misses': 0, 'rehashed': 0}
+        # Download directory holding package sources, None skips checking license files in them
+        self.dl_dir = dl_dir
+        # Records phase timings and I/O counters when --trace is given
+        self.tracer = tracer if tracer is not None else NullTracer()
+        # Reference license texts the license files in source archives are classified with, None skips it
+        self.license_index = license_index
+        # Set by the server, which keeps this object between checks
+        self.persistent = False
+        self.watcher = None
 
-    def find_dir(self, start_dir, target_name):
-        if target_name in start_dir:
-            return start_dir
+    def log(self, message):
+        lines = getattr(self.output, 'lines', None)
+        if lines is None:
+            print(message)
+        else:
+            lines.append(message)
+
+    def default_cache_file(self, start_dir, prefix, suffix='.json'):
+        # Keep cache files outside of the searched tree, writing them inside
+        # the tree would change the directory mtimes they are validated with
+        cache_home = os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache'))
+        digest = hashlib.sha1(os.path.abspath(start_dir).encode('utf-8')).hexdigest()
+        return os.path.join(cache_home, 'chk-license-info', '{0}-{1}{2}'.format(prefix, digest, suffix))
+
+    def load_license_index(self, texts_dir):
+        texts_dir = os.path.abspath(texts_dir)
+        self.license_index = LicenseIndex.load(texts_dir, self.default_cache_file(texts_dir, 'license-index', '.bin'))
+        return self.license_index
+
+    def write_json_file(self, file_path, data):
+        try:
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            tmp_file = '{0}.{1}'.format(file_path, os.getpid())
+            with open(tmp_file, 'w') as write_file:
+                json.dump(data, write_file)
+            os.replace(tmp_file, file_path)
+        except (IOError, OSError) as e:
+            if self.verbose_bol:
+                self.log('Could not save {0}: {1}'.format(file_path, e))
+
+    def scan_package_dirs(self, start_dir):
+        """
+        Walks start_dir once and returns ({dir_name: first_path}, {dir_path: mtime})
+        Directories are visited in the same order os.walk would visit them
+        """
+        packages = {}
+        dir_mtimes = {}
+        stack = [start_dir]
+        while stack:
+            root = stack.pop()
+            try:
+                dir_mtimes[root] = os.stat(root).st_mtime_ns
+                with os.scandir(root) as it:
+                    entries = list(it)
+            except OSError:
+                continue
+            sub_dirs = []
+            for entry in entries:
+                try:
+                    if not entry.is_dir():
+                        continue
+                except OSError:
+                    continue
+                # First match wins, same as the glob in the old per package walk
+                if entry.name not in packages:
+                    packages[entry.name] = entry.path
+                # Exclude directories from search to improve effeciency
+                # xxx dir has packages under "feeds" dir
+                if 'xxx' not in root and entry.name in self.exclude_list:
+                    continue
+                if not entry.is_dir(follow_symlinks=False):
+                    continue
+                sub_dirs.append(entry.path)
+            stack.extend(reversed(sub_dirs))
+        self.tracer.count('dirs walked', len(dir_mtimes))
+        return packages, dir_mtimes
+
+    def load_package_index(self, index_file, start_dir):
+        try:
+            with open(index_file, 'r') as read_file:
+                index = json.load(read_file)
+        except (IOError, OSError, ValueError):
+            return None
+        if index.get('start_dir') != start_dir or index.get('exclude_list') != self.exclude_list:
+            return None
+        # Any directory that gained or lost an entry has a new mtime
+        for dir_path, mtime in index['dirs'].items():
+            try:
+                if os.stat(dir_path).st_mtime_ns != mtime:
+                    return None
+            except OSError:
+                return None
+        return index['packages']
+
+    def save_package_index(self, index_file, start_dir, packages, dir_mtimes):
+        index = {'start_dir': start_dir, 'exclude_list': self.exclude_list,
+                 'dirs': dir_mtimes, 'packages': packages}
+        self.write_json_file(index_file, index)
+
+    def get_package_index(self, start_dir):
+        with self.index_lock:
+            if start_dir not in self.package_index:
+                self.package_index[start_dir] = self.build_package_index(start_dir)
+            return self.package_index[start_dir]
+
+    def build_package_index(self, start_dir):
+        index_file = self.index_file
+        if index_file == '':
+            index_file = self.default_cache_file(start_dir, 'index')
+        packages = None
+        if index_file:
+            packages = self.load_package_index(index_file, start_dir)
+            if packages is not None and self.verbose_bol:
+                self.log('Using package index {0}'.format(index_file))
+        if packages is None:
+            with self.tracer.phase('package index', start_dir=start_dir):
+                packages, dir_mtimes = self.scan_package_dirs(start_dir)
+            if index_file:
+                self.save_package_index(index_file, start_dir, packages, dir_mtimes)
+        return packages
+
+    def walk_find_dir(self, start_dir, target_name):
         for root, dirs, files in os.walk(start_dir):
             # Exclude directories from search to improve effeciency
             # xxx dir has packages under "feeds" dir
@@ -57,90 +554,822 @@ class CheckLicense(object):
             for target in glob.glob(os.path.join(root, target_name)):
                 if os.path.isdir(target):
                     return target
-        # Exit script if no file or directory is found
-        print('{0} was not found in {1}'.format(target_name, start_dir))
-        sys.exit(1)
+        raise PackageNotFoundError('{0} was not found in {1}'.format(target_name, start_dir))
 
-    def check_license_info(self, package_args):
-        for package_name in package_args:
-            # Get path to package Makefile
-            package_root_dir = self.find_dir(self.current_dir, package_name)
-            # Reset metadata for new package
-            metadata = {"package_name": package_name, "package_root_dir": package_root_dir,
-                        "root_makefile": False, "proprietary": False,
-                        "license_types": '', "license_file_names": '',
-                        "contains_gpl": False, "pass": True}
-            # Get data from makefile
-            if self.verbose_bol:
-                print('Reading Makefile information: {0}'.format(metadata['package_name']))
-            metadata = self.parse_makefile(metadata)
+    def lookup_package_index(self, start_dir, target_name):
+        packages = self.get_package_index(start_dir)
+        if re.search('[*?[]', target_name):
+            # Insertion order is walk order, so the first match is the one glob would find
+            for dir_name, dir_path in packages.items():
+                if fnmatch.fnmatch(dir_name, target_name):
+                    return dir_path
+        elif target_name in packages:
+            return packages[target_name]
+        return None
 
-            if not metadata["root_makefile"]:
-                print('{0}........FAILED {1}/Makefile does not exist:'.format(metadata['package_name'], metadata['package_root_dir']))
+    def find_dir(self, start_dir, target_name):
+        if target_name in start_dir:
+            return start_dir
+        if os.sep in target_name:
+            # Paths relative to a package parent can not be looked up by name
+            return self.walk_find_dir(start_dir, target_name)
+        dir_path = self.lookup_package_index(start_dir, target_name)
+        if self.persistent and (dir_path is None or not os.path.isdir(dir_path)):
+            # The server keeps the index between checks, packages added or moved since are found by a new walk
+            with self.index_lock:
+                self.package_index.pop(start_dir, None)
+            dir_path = self.lookup_package_index(start_dir, target_name)
+        if dir_path is not None:
+            return dir_path
+        raise PackageNotFoundError('{0} was not found in {1}'.format(target_name, start_dir))
 
-            # If package is proprietary
-            if metadata["proprietary"]:
-                if self.verbose_bol:
-                    print('{0}........PROPRIETARY'.format(metadata['package_name']))
-                print('{0}........PASS'.format(package_name))
-                if self.verbose_bol:
-                    print('')
+    def check_license_info(self, package_args, jobs=1):
+        """
+        Checks every package in package_args and prints the results in input order
+        Returns True if all packages passed
+        """
+        return self.print_results(self.iter_license_info(package_args, jobs))
+
+    def check_all_packages(self, jobs=1):
+        """
+        Checks every package found under the current directory, results are
+        printed as each package finishes
+        Returns True if all packages passed
+        """
+        return self.print_results(self.iter_all_packages(jobs))
+
+    def iter_license_info(self, package_args, jobs=1):
+        """
+        Yields a PackageResult for every package in package_args, in input order
+        """
+        return self.iter_checks(((package_name, None) for package_name in package_args), jobs)
+
+    def iter_all_packages(self, jobs=1):
+        """
+        Yields a PackageResult for every package found under the current directory
+        """
+        packages = ((os.path.basename(package_root_dir), package_root_dir)
+                    for package_root_dir in self.iter_package_dirs(self.current_dir))
+        return self.iter_checks(packages, jobs)
+
+    def iter_package_dirs(self, start_dir):
+        """
+        Yields every directory under start_dir whose Makefile defines a package
+        Package directories are not descended into, their nested Makefiles
+        are read by parse_makefile
+        """
+        # Feeds hold packages, package/feeds only links to them and links are not followed
+        exclude_list = [d for d in self.exclude_list if d != 'feeds']
+        stack = [start_dir]
+        while stack:
+            root = stack.pop()
+            try:
+                with os.scandir(root) as it:
+                    entries = list(it)
+            except OSError:
+                continue
+            self.tracer.count('dirs walked')
+            if root != start_dir and self.is_package_makefile(os.path.join(root, 'Makefile')):
+                yield root
                 continue
+            sub_dirs = []
+            for entry in entries:
+                try:
+                    if not entry.is_dir(follow_symlinks=False):
+                        continue
+                except OSError:
+                    continue
+                if 'xxx' not in root and entry.name in exclude_list:
+                    continue
+                sub_dirs.append(entry.path)
+            stack.extend(reversed(sub_dirs))
 
-            if metadata['license_types']:
-                # Checks if first license is gpl regardless of format presented
-                if re.match('^L?GPL.*$', metadata['license_types'][0], re.IGNORECASE):
-                    # If gpl license is not in correct format print error
-                    if not re.match('^L?GPL\-[0-9]\.[0-9]\+?$', metadata['license_types'][0]):
-                        print('{0}........FAILED PKG_LICENSE:={1} format is incorrect'.format(metadata['package_name'], metadata['license_types'][0]))
-                        print('\nCorrect format: <GPL type> - <version> ex: LGPL-2.1+ , GPL-3.0 , GPL-2.0+\n')
-                        metadata['pass'] = False
-                    elif self.verbose_bol:
-                        print('{0}........PKG_LICENSE OK'.format(metadata['package_name']))
-                # Non-gpl license
-                elif self.verbose_bol:
-                    print('{0}........PKG_LICENSE OK'.format(metadata['package_name']))
+    def is_package_makefile(self, makefile_path):
+        # Directory Makefiles such as package/Makefile do not set PKG_NAME
+        try:
+            with open(makefile_path, 'r', errors='replace') as read_file:
+                self.tracer.count('files opened')
+                for line in read_file:
+                    if 'PKG_NAME' in line:
+                        return True
+        except (IOError, OSError):
+            pass
+        return False
+
+    def iter_checks(self, packages, jobs=1):
+        """
+        Yields the PackageResult of (package_name, package_root_dir) pairs in
+        input order, package_root_dir may be None to search for the package.
+        Only a few packages are in flight at a time so packages can be a lazy
+        iterable of any length
+        """
+        try:
+            if jobs > 1:
+                with ThreadPoolExecutor(max_workers=jobs) as executor:
+                    pending = deque()
+                    for package_name, package_root_dir in packages:
+                        pending.append(executor.submit(self.check_package, package_name, package_root_dir))
+                        if len(pending) >= jobs * 2:
+                            yield pending.popleft().result()
+                    while pending:
+                        yield pending.popleft().result()
             else:
-                print('{0}........FAILED PKG_LICENSE is missing or empty'.format(metadata['package_name']))
-                metadata['pass'] = False
+                for package_name, package_root_dir in packages:
+                    yield self.check_package(package_name, package_root_dir)
+        finally:
+            self.save_result_cache()
+
+    def print_results(self, results):
+        """
+        Prints results as text, a package that is not found ends the check
+        Returns True if all packages passed
+        """
+        all_passed = True
+        for result in results:
+            for line in result.lines:
+                print(line)
+            sys.stdout.flush()
+            if result.status == 'NOT_FOUND':
+                results.close()
+                sys.exit(1)
+            all_passed = result.passed and all_passed
+        return all_passed
 
-            if not metadata['license_file_names']:
-                print('{0}........FAILED PKG_LICENSE_FILES is missing or empty'.format(metadata['package_name']))
-                metadata['pass'] = False
+    def fail(self, metadata, reason):
+        self.log('{0}........FAILED {1}'.format(metadata['package_name'], reason))
+        metadata['reasons'].append(reason)
+        metadata['pass'] = False
+
+    def check_package(self, package_name, package_root_dir=None):
+        """
+        Checks one package and returns its PackageResult
+        The text output is kept in the result instead of printed
+        """
+        outer_lines = getattr(self.output, 'lines', None)
+        self.output.lines = []
+        try:
+            with self.tracer.phase('check package', package=package_name):
+                metadata = {"package_name": package_name, "package_root_dir": package_root_dir, "reasons": []}
+                try:
+                    metadata = self.check_package_metadata(package_name, package_root_dir)
+                    status = 'PASS' if metadata['pass'] else 'FAILED'
+                except PackageNotFoundError as e:
+                    self.log(str(e))
+                    metadata['reasons'].append(str(e))
+                    status = 'NOT_FOUND'
+            return PackageResult(package_name, status, metadata['reasons'], metadata, self.output.lines)
+        finally:
+            self.output.lines = outer_lines
+
+    def check_package_metadata(self, package_name, package_root_dir=None):
+        # Get path to package Makefile
+        if package_root_dir is None:
+            package_root_dir = self.find_dir(self.current_dir, package_name)
+        # Reset metadata for new package
+        metadata = {"package_name": package_name, "package_root_dir": package_root_dir,
+                    "root_makefile": False, "proprietary": False,
+                    "license_types": '', "license_file_names": '',
+                    "contains_gpl": False, "source_file": '', "source_prefix": '',
+                    "pass": True, "reasons": []}
+        # Get data from makefile
+        if self.verbose_bol:
+            self.log('Reading Makefile information: {0}'.format(metadata['package_name']))
+        metadata = self.cached_parse_makefile(metadata)
+
+        if not metadata["root_makefile"]:
+            self.fail(metadata, '{0}/Makefile does not exist:'.format(metadata['package_root_dir']))
+
+        # If package is proprietary
+        if metadata["proprietary"]:
+            if self.verbose_bol:
+                self.log('{0}........PROPRIETARY'.format(metadata['package_name']))
+            self.log('{0}........PASS'.format(package_name))
+            if self.verbose_bol:
+                self.log('')
+            # Proprietary packages need no license info
+            metadata['reasons'] = []
+            metadata['pass'] = True
+            return metadata
+
+        if metadata['license_types']:
+            # Checks if first license is gpl regardless of format presented
+            if re.match('^L?GPL.*$', metadata['license_types'][0], re.IGNORECASE):
+                # If gpl license is not in correct format print error
+                if not re.match('^L?GPL\-[0-9]\.[0-9]\+?$', metadata['license_types'][0]):
+                    self.fail(metadata, 'PKG_LICENSE:={0} format is incorrect'.format(metadata['license_types'][0]))
+                    self.log('\nCorrect format: <GPL type> - <version> ex: LGPL-2.1+ , GPL-3.0 , GPL-2.0+\n')
+                elif self.verbose_bol:
+                    self.log('{0}........PKG_LICENSE OK'.format(metadata['package_name']))
+            # Non-gpl license
             elif self.verbose_bol:
-                print('{0}........PKG_LICENSE_FILES OK'.format(metadata['package_name']))
+                self.log('{0}........PKG_LICENSE OK'.format(metadata['package_name']))
+        else:
+            self.fail(metadata, 'PKG_LICENSE is missing or empty')
 
-            if metadata['pass']:
-                print('{0}........PASS'.format(metadata['package_name']))
-                if self.verbose_bol:
-                    print('')
-            else:
-                if self.verbose_bol:
-                    print('{0}........FAILED'.format(metadata['package_name']))
-                    print('')
-        return
+        if not metadata['license_file_names']:
+            self.fail(metadata, 'PKG_LICENSE_FILES is missing or empty')
+        elif self.verbose_bol:
+            self.log('{0}........PKG_LICENSE_FILES OK'.format(metadata['package_name']))
+
+        if self.dl_dir and metadata['license_file_names']:
+            self.verify_license_files(metadata)
+
+        if metadata['pass']:
+            self.log('{0}........PASS'.format(metadata['package_name']))
+            if self.verbose_bol:
+                self.log('')
+        else:
+            if self.verbose_bol:
+                self.log('{0}........FAILED'.format(metadata['package_name']))
+                self.log('')
+        return metadata
+
+    def get_cache_file(self):
+        if self.cache_file == '':
+            return self.default_cache_file(self.current_dir, 'results')
+        return self.cache_file
+
+    def load_result_cache(self):
+        # Called with cache_lock held
+        if self.result_cache is not None:
+            return self.result_cache
+        self.result_cache = {}
+        cache_file = self.get_cache_file()
+        if not cache_file:
+            return self.result_cache
+        try:
+            with open(cache_file, 'r') as read_file:
+                cache = json.load(read_file)
+            if cache.get('version') == RESULT_CACHE_VERSION:
+                self.result_cache = cache['packages']
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+        return self.result_cache
+
+    def save_result_cache(self):
+        cache_file = self.get_cache_file()
+        with self.cache_lock:
+            if not cache_file or not self.cache_dirty:
+                return
+            cache = {'version': RESULT_CACHE_VERSION, 'packages': self.result_cache}
+            self.write_json_file(cache_file, cache)
+            self.cache_dirty = False
+
+    def hash_file(self, file_path):
+        sha = hashlib.sha256()
+        with open(file_path, 'rb') as read_file:
+            for block in iter(lambda: read_file.read(65536), b''):
+                sha.update(block)
+            if self.tracer.enabled:
+                self.tracer.count('files opened')
+                self.tracer.count('bytes read', read_file.tell())
+        return sha.hexdigest()
+
+    def makefile_stamp(self, makefile_path):
+        stat = os.stat(makefile_path)
+        return [stat.st_mtime_ns, stat.st_size, self.hash_file(makefile_path)]
+
+    def cache_entry_valid(self, entry):
+        # A Makefile added or removed changes the mtime of its directory
+        for dir_path, mtime in entry['dirs'].items():
+            if os.stat(dir_path).st_mtime_ns != mtime:
+                return False
+        for makefile_path, stamp in entry['makefiles'].items():
+            stat = os.stat(makefile_path)
+            if [stat.st_mtime_ns, stat.st_size] == stamp[:2]:
+                continue
+            # Touched but maybe not changed, only the content hash decides
+            if self.hash_file(makefile_path) != stamp[2]:
+                return False
+            stamp[0], stamp[1] = stat.st_mtime_ns, stat.st_size
+            with self.cache_lock:
+                self.cache_stats['rehashed'] += 1
+                self.cache_dirty = True
+        return True
+
+    def cached_parse_makefile(self, metadata):
+        """
+        parse_makefile with results kept in the result cache, keyed on the
+        paths, mtimes and content hashes of the package's Makefiles
+        """
+        if not self.get_cache_file():
+            return self.parse_makefile(metadata)
+        package_root_dir = metadata['package_root_dir']
+        with self.cache_lock:
+            entry = self.load_result_cache().get(package_root_dir)
+        try:
+            # Packages the server watches are trusted until their Makefiles change
+            valid = entry is not None and ((self.watcher is not None and self.watcher.watching(package_root_dir))
+                                           or self.cache_entry_valid(entry))
+        except OSError:
+            valid = False
+        if valid:
+            if self.verbose_bol:
+                for makefile_path in entry['makefiles']:
+                    self.log(makefile_path)
+            metadata.update(entry['metadata'])
+            with self.cache_lock:
+                self.cache_stats['hits'] += 1
+            self.watch_package(package_root_dir, entry)
+            return metadata
+
+        makefiles, dir_mtimes = self.find_makefiles(package_root_dir)
+        metadata = self.parse_makefile(metadata, makefiles)
+        try:
+            entry = {'dirs': dir_mtimes,
+                     'makefiles': dict((makefile_path, self.makefile_stamp(makefile_path)) for makefile_path in makefiles),
+                     'metadata': dict((key, metadata[key]) for key in MAKEFILE_METADATA_KEYS)}
+        except OSError:
+            entry = None
+        with self.cache_lock:
+            self.cache_stats['misses'] += 1
+            if entry is not None:
+                self.result_cache[package_root_dir] = entry
+                self.cache_dirty = True
+        if entry is not None:
+            self.watch_package(package_root_dir, entry)
+        return metadata
+
+    def watch_package(self, package_root_dir, entry):
+        if self.watcher is not None and not self.watcher.watching(package_root_dir):
+            self.watcher.watch(package_root_dir, entry['dirs'])
+
+    def find_makefiles(self, package_root_dir):
+        """
+        Returns the Makefiles under package_root_dir in walk order and the
+        mtimes of the directories searched
+        """
+        makefiles = []
+        dir_mtimes = {}
+        for root, dirs, files in os.walk(package_root_dir):
+            try:
+                dir_mtimes[root] = os.stat(root).st_mtime_ns
+            except OSError:
+                continue
+            # Vendored sources can be huge and never hold package Makefiles
+            dirs[:] = [d for d in dirs if d not in VENDORED_DIRS]
+            if 'Makefile' in files:
+                makefiles.append(os.path.join(root, 'Makefile'))
+        self.tracer.count('dirs walked', len(dir_mtimes))
+        return makefiles, dir_mtimes
+
+    def read_makefile_lines(self, read_file):
+        # Yields logical lines with backslash continuations joined
+        logical_line = ''
+        for line in read_file:
+            line = line.rstrip('\r\n')
+            if line.endswith('\\'):
+                logical_line += line[:-1] + ' '
+                continue
+            yield logical_line + line
+            logical_line = ''
+        if logical_line:
+            yield logical_line
+
+    def expand_makefile_value(self, value, variables, depth=0):
+        # Expands references to variables from the same Makefile, others are kept as is
+        if depth > 10 or '$' not in value:
+            return value
+        return MAKEFILE_VAR_RE.sub(
+            lambda m: self.expand_makefile_value(variables[m.group(1)], variables, depth + 1)
+            if m.group(1) in variables else m.group(0), value)
+
+    def scan_makefile(self, makefile_path):
+        """
+        Reads a Makefile in one pass and returns (variables, proprietary)
+        """
+        variables = {}
+        proprietary = False
+        in_define = False
+        with open(makefile_path, 'r', errors='replace') as read_file:
+            for line in self.read_makefile_lines(read_file):
+                # Check makefile to see if user_headers is included
+                if 'PKG_PROPRIETARY' in line:
+                    proprietary = True
+                stripped = line.lstrip()
+                if in_define:
+                    in_define = not stripped.startswith('endef')
+                    continue
+                if stripped.startswith('define '):
+                    in_define = True
+                    continue
+                match = MAKEFILE_ASSIGN_RE.match(line)
+                if not match:
+                    continue
+                name, operator, value = match.groups()
+                value = MAKEFILE_COMMENT_RE.sub('', value).rstrip()
+                if operator == '+=':
+                    variables[name] = (variables[name] + ' ' + value).strip() if name in variables else value
+                elif operator == '?=':
+                    variables.setdefault(name, value)
+                else:
+                    variables[name] = value
+            if self.tracer.enabled:
+                self.tracer.count('files opened')
+                self.tracer.count('bytes read', os.fstat(read_file.fileno()).st_size)
+        return variables, proprietary
 
-    def parse_makefile(self, metadata):
+    def parse_makefile(self, metadata, makefiles=None):
+        if makefiles is None:
+            makefiles, dir_mtimes = self.find_makefiles(metadata['package_root_dir'])
         # Multiple Makefiles may exist, so parse each one
-        for root, dirs, files in os.walk(metadata['package_root_dir']):
-            for makefile_path in glob.glob(os.path.join(root, 'Makefile')):
-                if self.verbose_bol:
-                    print(makefile_path)
-                if makefile_path == os.path.join(metadata['package_root_dir'], 'Makefile'):
-                    metadata['root_makefile'] = True
-                with open(makefile_path, 'r') as read_file:
-                    for line in read_file:
-                        # Check makefile to see if user_headers is included
-                        if 'PKG_PROPRIETARY' in line:
-                            metadata['proprietary'] = True
-                        if 'PKG_LICENSE:=' in line:
-                            if re.match('^.*\=\s?L?GPL.*$', line):
-                                metadata['contains_gpl'] = True
-                            metadata['license_types'] = line.split(':=')[1].split()
-                        if 'PKG_LICENSE_FILES:=' in line:
-                            metadata['license_file_names'] = line.split(':=')[1].split()
+        for makefile_path in makefiles:
+            if self.verbose_bol:
+                self.log(makefile_path)
+            if makefile_path == os.path.join(metadata['package_root_dir'], 'Makefile'):
+                metadata['root_makefile'] = True
+            variables, proprietary = self.scan_makefile(makefile_path)
+            if proprietary:
+                metadata['proprietary'] = True
+            if 'PKG_LICENSE' in variables:
+                metadata['license_types'] = self.expand_makefile_value(variables['PKG_LICENSE'], variables).split()
+                if any(re.match('^L?GPL', license_type) for license_type in metadata['license_types']):
+                    metadata['contains_gpl'] = True
+            if 'PKG_LICENSE_FILES' in variables:
+                metadata['license_file_names'] = self.expand_makefile_value(variables['PKG_LICENSE_FILES'], variables).split()
+            if 'PKG_SOURCE' in variables:
+                metadata['source_file'] = self.expand_makefile_value(variables['PKG_SOURCE'], variables)
+            if 'PKG_NAME' in variables and 'PKG_VERSION' in variables:
+                # Name package.mk gives the source when PKG_SOURCE is not set
+                metadata['source_prefix'] = self.expand_makefile_value(
+                    '{0}-{1}'.format(variables['PKG_NAME'], variables['PKG_VERSION']), variables)
         return metadata
 
+    def find_source_archive(self, metadata):
+        source_file = metadata['source_file']
+        if source_file and '$' not in source_file:
+            archive_path = os.path.join(self.dl_dir, source_file)
+            if os.path.isfile(archive_path):
+                return archive_path
+        source_prefix = metadata['source_prefix']
+        if source_prefix and '$' not in source_prefix:
+            for suffix in SOURCE_ARCHIVE_SUFFIXES:
+                archive_path = os.path.join(self.dl_dir, source_prefix + suffix)
+                if os.path.isfile(archive_path):
+                    return archive_path
+        return None
+
+    def read_archive_members(self, archive_path):
+        """
+        Returns the member names of a source archive without extracting it
+        tar archives are read as a stream so memory does not grow with their size
+        """
+        names = []
+        if archive_path.endswith('.zip'):
+            # The zip central directory is read without decompressing anything
+            with zipfile.ZipFile(archive_path) as zip_file:
+                names = zip_file.namelist()
+        else:
+            with tarfile.open(archive_path, 'r|*') as tar:
+                while True:
+                    member = tar.next()
+                    if member is None:
+                        break
+                    names.append(member.name)
+                    # TarFile keeps every member it reads, drop them as we go
+                    tar.members = []
+        return names
+
+    def get_archive_members(self, archive_path):
+        # Member lists are cached per archive so re-runs skip decompression
+        stat = os.stat(archive_path)
+        cache_file = None
+        if self.get_cache_file():
+            cache_file = self.default_cache_file(os.path.abspath(archive_path), 'members')
+            try:
+                with open(cache_file, 'r') as read_file:
+                    cache = json.load(read_file)
+                if cache['archive'] == archive_path and cache['stamp'] == [stat.st_mtime_ns, stat.st_size]:
+                    return cache['members']
+            except (IOError, OSError, ValueError, KeyError):
+                pass
+        with self.tracer.phase('read archive members', archive=archive_path):
+            names = self.read_archive_members(archive_path)
+        self.tracer.count('files opened')
+        self.tracer.count('bytes read', stat.st_size)
+        if cache_file:
+            self.write_json_file(cache_file, {'archive': archive_path,
+                                              'stamp': [stat.st_mtime_ns, stat.st_size],
+                                              'members': names})
+        return names
+
+    def verify_license_files(self, metadata):
+        """
+        Checks that each PKG_LICENSE_FILES entry is in the package source archive
+        Sets metadata['pass'] to False and returns the missing files
+        """
+        archive_path = self.find_source_archive(metadata)
+        if archive_path is None:
+            if self.verbose_bol:
+                self.log('{0}........PKG_LICENSE_FILES not verified, no source archive in {1}'.format(metadata['package_name'], self.dl_dir))
+            return []
+        try:
+            names = self.get_archive_members(archive_path)
+        except (IOError, OSError, tarfile.TarError, zipfile.BadZipfile) as e:
+            self.log('{0}........PKG_LICENSE_FILES not verified, can not read {1}: {2}'.format(metadata['package_name'], archive_path, e))
+            return []
+        source_files = set()
+        for name in names:
+            source_files.update(self.source_file_names(name))
+        missing = [file_name for file_name in metadata['license_file_names']
+                   if '$' not in file_name and file_name.strip('/') not in source_files]
+        for file_name in missing:
+            self.fail(metadata, 'PKG_LICENSE_FILES {0} is not in {1}'.format(file_name, os.path.basename(archive_path)))
+        if not missing and self.verbose_bol:
+            self.log('{0}........PKG_LICENSE_FILES found in {1}'.format(metadata['package_name'], os.path.basename(archive_path)))
+        if self.license_index is not None:
+            self.verify_license_texts(metadata, archive_path)
+        return missing
+
+    def source_file_names(self, member_name):
+        # Source archives usually have one top directory, license files are relative to it
+        name = member_name.rstrip('/')
+        if name.startswith('./'):
+            name = name[2:]
+        if '/' in name:
+            return [name, name.split('/', 1)[1]]
+        return [name]
+
+    def read_archive_files(self, archive_path, file_names):
+        """
+        Returns {file name: text} for the file_names found in a source archive
+        tar archives are read as a stream and only the wanted members are kept
+        """
+        wanted = set(file_names)
+        texts = {}
+        if archive_path.endswith('.zip'):
+            with zipfile.ZipFile(archive_path) as zip_file:
+                for info in zip_file.infolist():
+                    for name in wanted.intersection(self.source_file_names(info.filename)):
+                        if info.file_size <= LICENSE_FILE_MAX_SIZE:
+                            texts[name] = zip_file.read(info).decode('utf-8', 'replace')
+            return texts
+        with tarfile.open(archive_path, 'r|*') as tar:
+            while True:
+                member = tar.next()
+                if member is None:
+                    break
+                names = wanted.intersection(self.source_file_names(member.name))
+                if names and member.isfile() and member.size <= LICENSE_FILE_MAX_SIZE:
+                    text = tar.extractfile(member).read().decode('utf-8', 'replace')
+                    for name in names:
+                        texts[name] = text
+                # TarFile keeps every member it reads, drop them as we go
+                tar.members = []
+        return texts
+
+    def get_license_classes(self, archive_path, file_names):
+        """
+        Returns {file name: license id or None} for the license files in a
+        source archive, cached per archive and license index
+        """
+        stat = os.stat(archive_path)
+        stamp = [stat.st_mtime_ns, stat.st_size, self.license_index.stamp()]
+        cache_file = None
+        if self.get_cache_file():
+            cache_file = self.default_cache_file(os.path.abspath(archive_path), 'licenses')
+            try:
+                with open(cache_file, 'r') as read_file:
+                    cache = json.load(read_file)
+                if cache['archive'] == archive_path and cache['stamp'] == stamp and \
+                        set(file_names).issubset(cache['classes']):
+                    return cache['classes']
+            except (IOError, OSError, ValueError, KeyError):
+                pass
+        with self.tracer.phase('classify license files', archive=archive_path):
+            texts = self.read_archive_files(archive_path, file_names)
+            classes = {}
+            for file_name in file_names:
+                classes[file_name] = None
+                if file_name in texts:
+                    classes[file_name] = self.license_index.classify(texts[file_name])[0]
+        self.tracer.count('license files classified', len(texts))
+        if cache_file:
+            self.write_json_file(cache_file, {'archive': archive_path, 'stamp': stamp, 'classes': classes})
+        return classes
+
+    def verify_license_texts(self, metadata, archive_path):
+        """
+        Checks that the license files paired with PKG_LICENSE hold the
+        declared license. Only the first license and gpl licenses are paired
+        with the file in the same position, see rule 2 above, and only
+        licenses in the index and files it recognises are compared.
+        Sets metadata['pass'] to False and returns
+        [(file name, declared license, found license)]
+        """
+        pairs = [(license_type, file_name) for index, (license_type, file_name)
+                 in enumerate(zip(metadata['license_types'], metadata['license_file_names']))
+                 if (index == 0 or re.match('^L?GPL', license_type, re.IGNORECASE))
+                 and '$' not in file_name and self.license_index.knows(license_type)]
+        if not pairs:
+            return []
+        try:
+            classes = self.get_license_classes(archive_path, [file_name.strip('/') for license_type, file_name in pairs])
+        except (IOError, OSError, tarfile.TarError, zipfile.BadZipfile) as e:
+            self.log('{0}........PKG_LICENSE not verified, can not read {1}: {2}'.format(metadata['package_name'], archive_path, e))
+            return []
+        mismatches = []
+        for license_type, file_name in pairs:
+            found = classes.get(file_name.strip('/'))
+            if found is None:
+                if self.verbose_bol:
+                    self.log('{0}........{1} is not a known license text'.format(metadata['package_name'], file_name))
+            elif license_base(found) != license_base(license_type):
+                mismatches.append((file_name, license_type, found))
+                self.fail(metadata, 'PKG_LICENSE {0} but {1} is {2}'.format(license_type, file_name, found))
+            elif self.verbose_bol:
+                self.log('{0}........{1} is {2}'.format(metadata['package_name'], file_name, found))
+        return mismatches
+
+
+def open_makefile_watcher():
+    # inotify is Linux only, elsewhere the server validates cached results with stat
+    try:
+        return MakefileWatcher()
+    except (OSError, AttributeError):
+        return None
+
+
+def print_cache_stats(check_package):
+    print('\nResult cache: {0} hits, {1} misses, {2} rehashed, {3}'.format(
+        check_package.cache_stats['hits'], check_package.cache_stats['misses'],
+        check_package.cache_stats['rehashed'], check_package.get_cache_file() or 'disabled'))
+
+
+def write_json_results(results, stream):
+    """
+    Writes results as one JSON document, each package is written as it finishes
+    Returns True if all packages passed
+    """
+    all_passed = True
+    stream.write('{"packages": [')
+    for index, result in enumerate(results):
+        stream.write(',\n' if index else '\n')
+        stream.write(json.dumps(result.to_dict()))
+        stream.flush()
+        all_passed = result.passed and all_passed
+    stream.write('\n], "passed": {0}}}\n'.format(json.dumps(all_passed)))
+    return all_passed
+
+
+def write_junit_results(results, stream):
+    """
+    Writes results as a JUnit XML test suite with one test case per package
+    Returns True if all packages passed
+    """
+    suite = ElementTree.Element('testsuite', name='chk-license-info')
+    counts = {'tests': 0, 'failures': 0, 'errors': 0}
+    for result in results:
+        counts['tests'] += 1
+        case = ElementTree.SubElement(suite, 'testcase', classname='chk-license-info', name=result.package_name)
+        # A package that is not found could not be checked at all
+        if result.status == 'NOT_FOUND':
+            counts['errors'] += 1
+            ElementTree.SubElement(case, 'error', message='; '.join(result.reasons))
+        elif not result.passed:
+            counts['failures'] += 1
+            failure = ElementTree.SubElement(case, 'failure', message='; '.join(result.reasons))
+            failure.text = '\n'.join(result.reasons)
+        ElementTree.SubElement(case, 'system-out').text = '\n'.join(result.lines)
+    for key in ['tests', 'failures', 'errors']:
+        suite.set(key, str(counts[key]))
+    ElementTree.ElementTree(suite).write(stream, encoding='unicode', xml_declaration=True)
+    stream.write('\n')
+    return counts['failures'] == 0 and counts['errors'] == 0
+
+
+def check_packages(package_names=None, start_dir=None, jobs=1, dl_dir=None, license_texts=None,
+                   index_file='', cache_file='', verbose=False):
+    """
+    Yields a PackageResult for each package in package_names, or for every
+    package under start_dir when package_names is None. Packages are checked
+    as the results are read. The script name has dashes so it is imported
+    by path:
+        spec = importlib.util.spec_from_file_location('chk_license_info', script_path)
+        chk_license_info = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(chk_license_info)
+        failed = [result for result in chk_license_info.check_packages(['busybox']) if not result.passed]
+    """
+    check_package = CheckLicense(verbose, index_file, cache_file, dl_dir, start_dir=start_dir)
+    if license_texts:
+        check_package.load_license_index(license_texts)
+    if package_names is None:
+        return check_package.iter_all_packages(jobs)
+    return check_package.iter_license_info(package_names, jobs)
+
+
+def run_server_check(checkers, arg, request):
+    """
+    Runs one client request and returns (exit status, stopped early)
+    One CheckLicense is kept per tree and download directory
+    """
+    key = (request['cwd'], request['dl_dir'])
+    if key not in checkers:
+        check_package = CheckLicense(False, arg.index_file, arg.cache_file, request['dl_dir'],
+                                     start_dir=request['cwd'])
+        check_package.persistent = True
+        if arg.license_texts:
+            check_package.load_license_index(arg.license_texts)
+        check_package.watcher = open_makefile_watcher()
+        checkers[key] = check_package
+    check_package = checkers[key]
+    if check_package.watcher is not None:
+        check_package.watcher.read_changes()
+    check_package.verbose_bol = request['verbose']
+    check_package.cache_stats = {'hits': 0, 'misses': 0, 'rehashed': 0}
+    try:
+        if request['all']:
+            all_passed = check_package.check_all_packages(request['jobs'])
+        else:
+            all_passed = check_package.check_license_info(request['packages'], request['jobs'])
+    except SystemExit as e:
+        # A package was not found, the client exits like the local check does
+        return e.code, 1
+    if request['cache_stats']:
+        print_cache_stats(check_package)
+    return (0 if all_passed else 1), 0
+
+
+def serve_checks(arg):
+    """
+    Answers check requests from --server clients on a Unix socket. The
+    package index and parsed Makefiles are kept in memory between requests
+    """
+    socket_path = os.path.abspath(arg.serve_socket)
+    if os.path.exists(socket_path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(socket_path)
+            print('A server is already listening on {0}'.format(socket_path))
+            sys.exit(1)
+        except OSError:
+            # Left behind by a server that did not exit cleanly
+            os.remove(socket_path)
+        finally:
+            probe.close()
+    checkers = {}
+
+    class CheckHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            request = json.loads(self.rfile.readline().decode('utf-8'))
+            output = io.TextIOWrapper(self.wfile, encoding='utf-8', write_through=True)
+            with redirect_stdout(output):
+                try:
+                    status, stopped = run_server_check(checkers, arg, request)
+                except Exception as e:
+                    print('chk-license-info server error: {0}'.format(e))
+                    status, stopped = 1, 1
+            output.write('{0}{1} {2}\n'.format(SERVER_STATUS_MARK, status, stopped))
+            output.detach()
+
+    # Requests are answered one at a time, checks with --jobs still run in parallel
+    server = socketserver.UnixStreamServer(socket_path, CheckHandler)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    print('Listening on {0}'.format(socket_path))
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(socket_path)
+
+
+def request_checks(arg, dl_dir):
+    """
+    Sends the check to a --serve server and prints its output
+    Returns the exit status, or None when no server is listening
+    """
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(arg.server_socket)
+    except OSError:
+        client.close()
+        return None
+    request = {'cwd': os.getcwd(), 'packages': arg.input_pkg_name, 'all': arg.all_bol, 'jobs': arg.jobs,
+               'verbose': arg.verbose_bol, 'dl_dir': dl_dir, 'cache_stats': arg.cache_stats_bol}
+    with client, client.makefile('r', encoding='utf-8', newline='\n') as response:
+        client.sendall((json.dumps(request) + '\n').encode('utf-8'))
+        for line in response:
+            if line.startswith(SERVER_STATUS_MARK):
+                status, stopped = [int(field) for field in line[len(SERVER_STATUS_MARK):].split()]
+                if stopped:
+                    sys.exit(status)
+                return status
+            sys.stdout.write(line)
+            sys.stdout.flush()
+    print('chk-license-info server closed the connection')
+    sys.exit(1)
+
+
+def classify_files(arg):
+    license_index = CheckLicense(arg.verbose_bol).load_license_index(arg.license_texts)
+    for file_path in arg.input_pkg_name:
+        with open(file_path, 'r', errors='replace') as read_file:
+            license_id, score = license_index.classify(read_file.read())
+        print('{0}........{1} {2:.2f}'.format(file_path, license_id or 'UNKNOWN', score))
+
 
 def parse_program_arguments():
     """
@@ -151,30 +1380,153 @@ def parse_program_arguments():
                                                 proprietary then PKG_LICENSE and PKG_LICENSE_FILES are not needed.
                                                 For packages under xxx directory run the script in the package's directory
                                                 """,
-                                     usage='chk-licenses-info <package name> <package_name> etc..')
+                                     usage='chk-licenses-info [--all] <package name> <package_name> etc..')
     parser.add_argument('-v',
                         action='store_true',
                         dest='verbose_bol',
                         help='displays all information')
+    parser.add_argument('--all',
+                        action='store_true',
+                        dest='all_bol',
+                        help='check every package under the current directory, including feeds')
+    parser.add_argument('--jobs', '-j',
+                        action='store',
+                        type=int,
+                        dest='jobs',
+                        default=1,
+                        help='number of packages to check at the same time')
+    parser.add_argument('--index-file',
+                        action='store',
+                        dest='index_file',
+                        default='',
+                        help='file used to keep the package directory index between runs (default: under ~/.cache)')
+    parser.add_argument('--no-index',
+                        action='store_const',
+                        const=None,
+                        dest='index_file',
+                        help='do not load or save the package directory index')
+    parser.add_argument('--verify-sources',
+                        action='store_true',
+                        dest='verify_sources_bol',
+                        help='check that PKG_LICENSE_FILES exist in the package source archive in the download directory')
+    parser.add_argument('--dl-dir',
+                        action='store',
+                        dest='dl_dir',
+                        default='dl',
+                        help='download directory holding the package sources (default: dl)')
+    parser.add_argument('--license-texts',
+                        action='store',
+                        dest='license_texts',
+                        default='',
+                        help="""directory of reference license texts named by SPDX id, such as the text directory of
+                                spdx/license-list-data or LICENSES/preferred of the Linux kernel. With --verify-sources
+                                license files are classified and checked against PKG_LICENSE""")
+    parser.add_argument('--classify',
+                        action='store_true',
+                        dest='classify_bol',
+                        help='print the license of each file given instead of checking packages, needs --license-texts')
+    parser.add_argument('--cache-file',
+                        action='store',
+                        dest='cache_file',
+                        default='',
+                        help='file used to keep Makefile results between runs (default: under ~/.cache)')
+    parser.add_argument('--no-cache',
+                        action='store_const',
+                        const=None,
+                        dest='cache_file',
+                        help='parse every Makefile and do not load or save cached results')
+    parser.add_argument('--cache-stats',
+                        action='store_true',
+                        dest='cache_stats_bol',
+                        help='print result cache hits and misses at the end of the check')
+    parser.add_argument('--trace',
+                        action='store',
+                        dest='trace_file',
+                        default='',
+                        help='write phase timings and I/O counters to this file in Chrome trace-event JSON format')
+    parser.add_argument('--format',
+                        action='store',
+                        choices=OUTPUT_FORMATS,
+                        dest='output_format',
+                        default='text',
+                        help="""output format, json and junit print one document for CI dashboards and check every
+                                package even when one is not found (default: text)""")
+    parser.add_argument('--serve',
+                        action='store',
+                        dest='serve_socket',
+                        default='',
+                        help='keep the package index and parsed Makefiles in memory and answer --server checks on this Unix socket')
+    parser.add_argument('--server',
+                        action='store',
+                        dest='server_socket',
+                        default='',
+                        help='send the check to a --serve server on this Unix socket, checks locally when no server is listening')
     parser.add_argument('input_pkg_name',
                         action='store',
                         type=str,
-                        nargs='+')
-    return parser.parse_known_args()
+                        nargs='*')
+    arg, extra = parser.parse_known_args()
+    if not arg.input_pkg_name and not arg.all_bol and not arg.serve_socket:
+        parser.error('a package name or --all is required')
+    if arg.classify_bol and not arg.license_texts:
+        parser.error('--classify needs --license-texts')
+    if arg.license_texts and not arg.verify_sources_bol and not arg.classify_bol and not arg.serve_socket:
+        parser.error('--license-texts needs --verify-sources or --classify')
+    return arg, extra
 
 
 if __name__ == "__main__":
     arg, extra = parse_program_arguments()
+    if arg.serve_socket:
+        serve_checks(arg)
+        sys.exit(0)
+    if arg.classify_bol:
+        classify_files(arg)
+        sys.exit(0)
+    text_bol = arg.output_format == 'text'
     # For output formating purposes
-    print('')
-    if arg.verbose_bol:
+    if text_bol:
+        print('')
+    if text_bol and arg.verbose_bol:
         print('\t........Starting Check........\n')
 
-    check_package = CheckLicense(arg.verbose_bol)
-    check_package.check_license_info(arg.input_pkg_name)
+    dl_dir = os.path.abspath(arg.dl_dir) if arg.verify_sources_bol else None
+    status = None
+    # The server only answers with text, other formats are checked locally
+    if arg.server_socket and text_bol:
+        status = request_checks(arg, dl_dir)
+    if status is None:
+        tracer = None
+        if arg.trace_file:
+            tracer = Tracer()
+            # Written on every exit so failed and interrupted checks are traced too
+            atexit.register(tracer.write, os.path.abspath(arg.trace_file))
+        check_package = CheckLicense(arg.verbose_bol, arg.index_file, arg.cache_file, dl_dir, tracer)
+        if arg.license_texts:
+            check_package.load_license_index(arg.license_texts)
+        with check_package.tracer.phase('check', jobs=arg.jobs):
+            if arg.all_bol:
+                results = check_package.iter_all_packages(arg.jobs)
+            else:
+                results = check_package.iter_license_info(arg.input_pkg_name, arg.jobs)
+            if arg.output_format == 'json':
+                all_passed = write_json_results(results, sys.stdout)
+            elif arg.output_format == 'junit':
+                all_passed = write_junit_results(results, sys.stdout)
+            else:
+                all_passed = check_package.print_results(results)
+        if arg.cache_stats_bol:
+            # Kept out of the json and junit documents
+            with redirect_stdout(sys.stdout if text_bol else sys.stderr):
+                print_cache_stats(check_package)
+        status = 0 if all_passed else 1
 
     # For output formating purposes
-    if not arg.verbose_bol:
+    if text_bol and not arg.verbose_bol:
         print('')
-    if arg.verbose_bol:
+    if text_bol and arg.verbose_bol:
         print('\t........End Of Check........\n')
+
+    # Non zero exit status so CI can gate on the check
+    if status:
+        sys.exit(status)